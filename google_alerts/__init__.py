@@ -1,17 +1,28 @@
 #!/usr/bin/env python
 """Abstract API over the Google Alerts service."""
 import base64
+import contextlib
+import copy
+import hashlib
 import json
 import logging
 import os
 import pickle
 import re
 import sys
+import tempfile
+import threading
+import time
 
 import requests
 import requests.utils
 from bs4 import BeautifulSoup
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 __author__ = "Brandon Dixon"
 __copyright__ = "Copyright, Brandion Dixon"
 __credits__ = ["Brandon Dixon"]
@@ -61,6 +72,11 @@ class ActionError(Exception):
     pass
 
 
+class InvalidQuery(Exception):
+    """Exception for search queries that can't be run."""
+    pass
+
+
 def obfuscate(p, action):
     """Obfuscate the auth details to avoid easy snatching.
 
@@ -95,9 +111,304 @@ CONFIG_PATH = os.path.expanduser('~/.config/google_alerts')
 CONFIG_FILE = os.path.join(CONFIG_PATH, 'config.json')
 SESSION_FILE = os.path.join(CONFIG_PATH, 'session')
 CONFIG_DEFAULTS = {'email': '', 'password': '', 'py2': PY2}
+ENV_PREFIX = 'GOOGLE_ALERTS_'
+STATE_VERSION = 1
+_LOGGER_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Hold an exclusive lock on a sidecar file for `path`.
+
+    The lock is advisory and only guards writers that go through this helper.
+    Platforms without `fcntl` fall back to no locking.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path + '.lock', 'a') as handle:
+        if fcntl:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+def _account_key(email):
+    """Return a stable file name friendly key for an account email."""
+    return hashlib.sha1((email or '').lower().encode('utf-8')).hexdigest()[:16]
+
+
+def _atomic_write(path, data, mode='w'):
+    """Write data to a temporary file and move it into place.
+
+    Readers will either see the old file or the new one, never a partial
+    write.
+    """
+    directory = os.path.dirname(path) or '.'
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory,
+                               prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # Unlike rename, replace overwrites an existing file on Windows too
+        getattr(os, 'replace', os.rename)(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+class MemoryConfig(object):
+    """Configuration held in memory only.
+
+    This is the default source when credentials are passed to the client and
+    never touches the file system.
+    """
+
+    persist = False
+
+    def __init__(self, email='', password=''):
+        self._email = email or ''
+        self._password = password or ''
+
+    def load(self):
+        """Return the configuration with the password in the clear."""
+        config = dict(CONFIG_DEFAULTS)
+        config.update({'email': self._email, 'password': self._password})
+        return config
+
+    def save(self, email, password):
+        """Replace the credentials held in memory."""
+        self._email = email
+        self._password = password
+
+
+class EnvConfig(object):
+    """Configuration read from environment variables.
+
+    Reads `GOOGLE_ALERTS_EMAIL` and `GOOGLE_ALERTS_PASSWORD` by default. The
+    environment is treated as read-only.
+    """
+
+    persist = False
+
+    def __init__(self, prefix=ENV_PREFIX):
+        self._prefix = prefix
+
+    def load(self):
+        """Return the configuration with the password in the clear."""
+        config = dict(CONFIG_DEFAULTS)
+        config['email'] = os.environ.get(self._prefix + 'EMAIL', '')
+        config['password'] = os.environ.get(self._prefix + 'PASSWORD', '')
+        return config
+
+    def save(self, email, password):
+        raise InvalidConfig("Environment configuration is read-only.")
+
+
+class FileConfig(object):
+    """Configuration stored in a JSON file with an obfuscated password.
+
+    Loading never writes to disk. Credentials passed to the client are only
+    written back when `persist` is set, and those writes are atomic and
+    serialized through a lock file so concurrent processes cannot corrupt
+    the configuration.
+    """
+
+    def __init__(self, path=CONFIG_FILE, persist=False):
+        self.path = path
+        self.persist = persist
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return dict(CONFIG_DEFAULTS)
+        with open(self.path) as f:
+            config = json.load(f)
+        if config.get('py2', PY2) != PY2:
+            raise InvalidConfig("Python versions have changed. Please run `setup` again to reconfigure the client.")
+        return config
+
+    def load(self):
+        """Return the configuration with the password in the clear."""
+        config = self._read()
+        if config.get('password'):
+            config['password'] = obfuscate(str(config['password']), 'fetch')
+        return config
+
+    def save(self, email, password):
+        """Write the credentials to the configuration file.
+
+        Nothing is written when the file already holds them.
+        """
+        with _file_lock(self.path):
+            config = self._read()
+            stored = config.get('password')
+            if config.get('email') == email and stored and \
+                    obfuscate(str(stored), 'fetch') == password:
+                return
+            config['email'] = email
+            config['password'] = str(obfuscate(password, 'store'))
+            config['py2'] = PY2
+            _atomic_write(self.path, json.dumps(config, indent=4,
+                                                separators=(',', ': ')))
+
+
+class MemorySessionStore(object):
+    """Session cookies kept in memory for the life of the process.
+
+    Clients sharing one store share their session and only one of them will
+    log in when it expires.
+    """
+
+    def __init__(self):
+        self._sessions = dict()
+        self._locks = dict()
+        self._guard = threading.Lock()
+
+    def load(self, email):
+        """Return the cookies saved for the account, if any."""
+        return dict(self._sessions.get(email, {})) or None
+
+    def save(self, email, cookies):
+        """Save the cookies for the account."""
+        self._sessions[email] = dict(cookies)
+
+    def lock(self, email):
+        """Return a lock held while the account session is refreshed."""
+        with self._guard:
+            return self._locks.setdefault(email, threading.Lock())
+
+
+class FileSessionStore(object):
+    """Session cookies shared between processes through the file system.
+
+    Each account gets its own session file inside `path`, keyed by a hash of
+    the email. Writes are atomic and refreshing a session happens under an
+    exclusive lock file, so when a session expires only one process logs in
+    and the others pick up the new cookies once the lock is released.
+
+    The legacy single `SESSION_FILE` only belongs to the account it was
+    seeded for, `owner`, which defaults to the email of the configuration
+    file next to it. That account moves it to its own session file the
+    first time it is loaded, other accounts never see it.
+    """
+
+    def __init__(self, path=CONFIG_PATH, fallback=SESSION_FILE, owner=None):
+        self.path = path
+        self.fallback = fallback
+        self.owner = owner
+
+    def _file(self, email):
+        return os.path.join(self.path, 'session-%s' % _account_key(email))
+
+    def _owner(self):
+        if self.owner is not None:
+            return self.owner
+        config = FileConfig(os.path.join(os.path.dirname(self.fallback),
+                                         'config.json'))
+        try:
+            return config._read().get('email')
+        except (ValueError, InvalidConfig):
+            return None
+
+    def _migrate(self, email, path):
+        """Move the legacy session file to the session file of `email`."""
+        if not self.fallback or not os.path.exists(self.fallback):
+            return
+        owner = self._owner()
+        if not owner or owner.lower() != (email or '').lower():
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        try:
+            # Linking fails if another process migrated or logged in first
+            os.link(self.fallback, path)
+            os.remove(self.fallback)
+        except OSError:
+            pass
+
+    def load(self, email):
+        """Return the cookies saved for the account, if any."""
+        path = self._file(email)
+        if not os.path.exists(path):
+            self._migrate(email, path)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, email, cookies):
+        """Save the cookies for the account."""
+        _atomic_write(self._file(email), pickle.dumps(dict(cookies),
+                                                      protocol=2), 'wb')
+
+    def lock(self, email):
+        """Return a lock held while the account session is refreshed."""
+        return _file_lock(self._file(email))
+
+
+class FileStateCache(object):
+    """Last fetched application state per account, kept on disk.
+
+    Every live state fetch is written to a versioned JSON file along with the
+    time it was fetched and its `requestX` token. Other processes can then
+    list monitors from the snapshot without authenticating. Writes are
+    atomic and never replace a snapshot with an older one.
+    """
+
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+
+    def _file(self, email):
+        return os.path.join(self.path, 'state-%s.json' % _account_key(email))
+
+    def load(self, email):
+        """Return the snapshot for the account or None if there is none.
+
+        Snapshots written by a different format version are ignored.
+        """
+        path = self._file(email)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except ValueError:
+            return None
+        if snapshot.get('version') != STATE_VERSION:
+            return None
+        return snapshot
+
+    def save(self, email, state, fetched_at):
+        """Save a fetched state for the account."""
+        path = self._file(email)
+        with _file_lock(path):
+            current = self.load(email)
+            if current and current['fetched_at'] > fetched_at:
+                return
+            snapshot = {'version': STATE_VERSION, 'email': email,
+                        'fetched_at': fetched_at, 'request_x': state[2],
+                        'state': state}
+            _atomic_write(path, json.dumps(snapshot))
 
 
 class GoogleAlerts:
+    """Client for managing the alerts of a single Google account.
+
+    Instances are thread-safe and one client can serve a whole pool of
+    worker threads. Authentication and session refreshes are serialized by
+    their own lock, while the state is swapped under a second lock that is
+    never held across a request, so readers never wait on the network. The
+    state is only ever replaced and never modified in place, and options
+    passed in by callers are copied before use. Use `snapshot()` to get a
+    private copy of the current state.
+    """
 
     NAME = "GoogleAlerts"
     LOG_LEVEL = logging.DEBUG
@@ -127,83 +438,104 @@ class GoogleAlerts:
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.90 Safari/537.36'
     }
 
-    def __init__(self, email=None, password=None):
+    def __init__(self, email=None, password=None, config=None,
+                 session_store=None, state_cache=None):
         self._log = self._logger()
         self._email = email
         self._password = password
         self._is_authenticated = False
         self._state = None
+        self._state_fetched_at = None
+        self._lock = threading.RLock()
+        self._auth_lock = threading.RLock()
+        self._cache_lock = threading.Lock()
         self._session = requests.session()
+        if config is None:
+            if email and password:
+                config = MemoryConfig(email, password)
+            else:
+                config = FileConfig()
+        self._config = config
+        if session_store is None:
+            # Only clients configured from files touch the disk by default
+            if isinstance(config, FileConfig):
+                session_store = FileSessionStore()
+            else:
+                session_store = MemorySessionStore()
+        self._sessions = session_store
+        self._state_cache = state_cache
         self._config_bootstrap()
 
     def _config_bootstrap(self):
-        """Go through and establish the defaults on the file system.
+        """Resolve the credentials from the configuration source.
 
-        The approach here was stolen from the CLI tool provided with the
-        module. Idea being that the user should not always need to provide a
-        username and password in order to run the script. If the configuration
-        file is already present with valid data, then lets use it.
+        Idea being that the user should not always need to provide a username
+        and password in order to run the script. Passed credentials take
+        priority and are only written back when the source was created with
+        `persist` enabled. Otherwise the source is read, which for the default
+        `FileConfig` is the file written by the `setup` command. No file is
+        created when none exists.
         """
-        if not os.path.exists(CONFIG_PATH):
-            os.makedirs(CONFIG_PATH)
-        if not os.path.exists(CONFIG_FILE):
-            json.dump(CONFIG_DEFAULTS, open(CONFIG_FILE, 'w'), indent=4,
-                      separators=(',', ': '))
-        config = CONFIG_DEFAULTS
         if self._email and self._password:
-            #  Save the configuration locally to pull later on
-            config['email'] = self._email
-            config['password'] = str(obfuscate(self._password, 'store'))
-            self._log.debug("Caching authentication in config file")
-            json.dump(config, open(CONFIG_FILE, 'w'), indent=4,
-                      separators=(',', ': '))
-        else:
-            #  Load the config file and override the class
-            config = json.load(open(CONFIG_FILE))
-            if config.get('py2', PY2) != PY2:
-                raise Exception("Python versions have changed. Please run `setup` again to reconfigure the client.")
-            if config['email'] and config['password']:
-                self._email = config['email']
-                self._password = obfuscate(str(config['password']), 'fetch')
-                self._log.debug("Loaded authentication from config file")
-
-    def _session_check(self):
-        """Attempt to authenticate the user through a session file.
+            if self._config.persist:
+                self._log.debug("Caching authentication in config file")
+                self._config.save(self._email, self._password)
+            return
+        config = self._config.load()
+        if config['email'] and config['password']:
+            self._email = config['email']
+            self._password = config['password']
+            self._log.debug("Loaded authentication from %s"
+                            % self._config.__class__.__name__)
+
+    def _session_check(self, cookies):
+        """Attempt to authenticate the user through saved session cookies.
 
         This process is done to avoid having to authenticate the user every
-        single time. It uses a session file that is saved when a valid session
-        is captured and then reused. Because sessions can expire, we need to
+        single time. It uses cookies that are saved when a valid session is
+        captured and then reused. Because sessions can expire, we need to
         test the session prior to calling the user authenticated. Right now
         that is done with a test string found in an unauthenticated session.
         This approach is not an ideal method, but it works.
         """
-        if not os.path.exists(SESSION_FILE):
-            self._log.debug("Session file does not exist")
+        if not cookies:
+            self._log.debug("No saved session for this account")
             return False
-        with open(SESSION_FILE, 'rb') as f:
-            cookies = requests.utils.cookiejar_from_dict(pickle.load(f))
-            self._session.cookies = cookies
-            self._log.debug("Loaded cookies from session file")
+        self._load_cookies(cookies)
+        return self._session_valid()
+
+    def _load_cookies(self, cookies):
+        """Replace the cookies of the session with saved ones."""
+        self._session.cookies = requests.utils.cookiejar_from_dict(cookies)
+        self._log.debug("Loaded cookies from session store")
+
+    def _session_valid(self):
+        """Test the cookies currently in the session, leaving them as is."""
         response = self._session.get(url=self.TEST_URL, headers=self.HEADERS)
         if self.TEST_KEY in str(response.content):
-            self._log.debug("Session file appears invalid")
+            self._log.debug("Session appears invalid")
             return False
-        self._is_authenticated = True
-        self._process_state()
         return True
 
     def _logger(self):
         """Create a logger to be used between processes.
 
+        The handler is only attached the first time, every other instance
+        reuses the same logger.
+
         :returns: Logging instance.
         """
         logger = logging.getLogger(self.NAME)
-        logger.setLevel(self.LOG_LEVEL)
-        shandler = logging.StreamHandler(sys.stdout)
-        fmt = '\033[1;32m%(levelname)-5s %(module)s:%(funcName)s():'
-        fmt += '%(lineno)d %(asctime)s\033[0m| %(message)s'
-        shandler.setFormatter(logging.Formatter(fmt))
-        logger.addHandler(shandler)
+        with _LOGGER_LOCK:
+            if getattr(logger, '_google_alerts', False):
+                return logger
+            logger.setLevel(self.LOG_LEVEL)
+            shandler = logging.StreamHandler(sys.stdout)
+            fmt = '\033[1;32m%(levelname)-5s %(module)s:%(funcName)s():'
+            fmt += '%(lineno)d %(asctime)s\033[0m| %(message)s'
+            shandler.setFormatter(logging.Formatter(fmt))
+            logger.addHandler(shandler)
+            logger._google_alerts = shandler
         return logger
 
     def set_log_level(self, level):
@@ -216,17 +548,36 @@ class GoogleAlerts:
             level = logging.ERROR
         self._log.setLevel(level)
 
+    def set_log_stream(self, stream):
+        """Send the log output of the class to another stream.
+
+        Used by commands whose results go to stdout, so log lines never end
+        up mixed with them.
+        """
+        handler = self._log._google_alerts
+        handler.acquire()
+        try:
+            handler.flush()
+            handler.stream = stream
+        finally:
+            handler.release()
+
     def _process_state(self):
         """Process the application state configuration.
 
         Google Alerts manages the account information and alert data through
         some custom state configuration. Not all values have been completely
         enumerated.
+
+        The state is swapped in whole under the client lock and the parsed
+        state is returned, so callers work from the copy they fetched even if
+        another thread refreshes in the meantime.
         """
         self._log.debug("Capturing state from the request")
         response = self._session.get(url=self.ALERTS_URL, headers=self.HEADERS)
         soup = BeautifulSoup(response.content, "html.parser")
         p = re.compile('window.STATE=(.*);')
+        fetched = None
         for i in soup.findAll('script', {'src': False}):
             if not p.search(i.string):
                 continue
@@ -234,16 +585,75 @@ class GoogleAlerts:
                 match = p.search(i.string)
                 state = json.loads(match.group(0)[13:-6])
                 if state != "":
-                    self._state = state
-                    self._log.debug("State value set: %s" % self._state)
+                    fetched = state
+                    self._log.debug("State value set: %s" % state)
             except Exception as e:
                 raise StateParseFailure(
                     'Google has changed their core protocol and a new parser must be built. ' +
                     'Please file a bug at https://github.com/9b/google-alerts/issues.'
                 )
-        return self._state
+        with self._lock:
+            if fetched is not None:
+                self._state = fetched
+                self._state_fetched_at = time.time()
+            state = self._state
+        if fetched is not None:
+            self._save_state()
+        return state
+
+    def _save_state(self):
+        """Write the current state to the state cache, if there is one.
+
+        The state lock is only held to read the state, so readers never wait
+        on the disk. Writes are serialized by their own lock and always take
+        the latest state, so a write finishing late cannot leave an older
+        state behind.
+        """
+        if not self._state_cache:
+            return
+        with self._cache_lock:
+            with self._lock:
+                state, fetched_at = self._state, self._state_fetched_at
+            if fetched_at:
+                self._state_cache.save(self._email, state, fetched_at)
 
-    def _build_payload(self, term, options):
+    def state_age(self):
+        """Return the seconds since the state was last fetched, or None."""
+        if self._state_fetched_at is None:
+            return None
+        return time.time() - self._state_fetched_at
+
+    def refresh(self):
+        """Revalidate the session and fetch a fresh state.
+
+        The current cookies are tested in place and the client only goes
+        through `authenticate` when they have expired. Either way the state,
+        and with it the `requestX` token, is fetched again. The state lock is
+        only taken to swap in the new state.
+        """
+        with self._auth_lock:
+            if not self._session_valid():
+                self._log.debug("Session expired, authenticating again")
+                return self.authenticate()
+            self._process_state()
+
+    def keep_warm(self, interval=600, on_error=None):
+        """Start a background refresher for this client.
+
+        :returns: Running `StateRefresher`, call `stop()` when done.
+        """
+        refresher = StateRefresher(self, interval, on_error)
+        refresher.start()
+        return refresher
+
+    def snapshot(self):
+        """Return a private copy of the current application state."""
+        with self._lock:
+            return copy.deepcopy(self._state)
+
+    def _build_payload(self, term, options, request_x=None):
+        if request_x is None:
+            request_x = self._state[2]
         if 'delivery' not in options:
             raise InvalidConfig("`delivery` is required in options.")
         region = options.get('region', 'US')
@@ -263,26 +673,26 @@ class GoogleAlerts:
                        language, region], None, None, None, 0, 1], None,
                        monitor_match, [[None, 2, "", [], 1, "en-US", None,
                        None, None, None, None, "0", None, None,
-                       self._state[2]]]]]
+                       request_x]]]]
         else:
             if options['alert_frequency'] == 'AT_MOST_ONCE_A_DAY':
                 payload = [None, [None, None, None, [None, term, "com", [None,
                            language, region], None, None, None, 0, 1], None,
                            monitor_match, [[None, 1, self._email, [None, None, 3],
                            freq_option, "en-US", None, None, None, None, None, "0",
-                           None, None, self._state[2]]]]]
+                           None, None, request_x]]]]
             elif options['alert_frequency'] == 'AS_IT_HAPPENS':
                 payload = [None, [None, None, None, [None, term, "com", [None,
                            language, region], None, None, None, 0, 1], None,
                            monitor_match, [[None, 1, self._email, [], freq_option,
                            "en-US", None, None, None, None, None, "0",
-                           None, None, self._state[2]]]]]
+                           None, None, request_x]]]]
             elif options['alert_frequency'] == 'AT_MOST_ONCE_A_WEEK':
                 payload = [None, [None, None, None, [None, term, "com", [None,
                            language, region], None, None, None, 0, 1], None,
                            monitor_match, [[None, 1, self._email, [None, None, 0, 3],
                            freq_option, "en-US", None, None, None, None, None, "0",
-                           None, None, self._state[2]]]]]
+                           None, None, request_x]]]]
 
         if options.get('action') == 'MODIFY':
             payload.insert(1, options.get('monitor_id'))
@@ -290,12 +700,8 @@ class GoogleAlerts:
                 payload[2][6][0][11] = options['rss_id'].split('/')[-1]
         return payload
 
-    def authenticate(self):
-        """Authenticate the user and setup our state."""
-        valid = self._session_check()
-        if self._is_authenticated and valid:
-            self._log.debug("[!] User has already authenticated")
-            return
+    def _login(self):
+        """Perform a full login with the email and password."""
         init = self._session.get(url=self.LOGIN_URL, headers=self.HEADERS)
         soup = BeautifulSoup(init.content, "html.parser")
         soup_login = soup.find('form').find_all('input')
@@ -308,22 +714,53 @@ class GoogleAlerts:
         response = self._session.post(url=self.AUTH_URL, data=post_data,
                                       headers=self.HEADERS)
         if self.CAPTCHA_KEY in str(response.content):
-            raise AccountCaptcha('Google is forcing a CAPTCHA. To get around this issue, run the google-alerts with the seed option to open an interactive authentication session. Once authenticated, this module will cache your session and load that in the future')
+            raise AccountCaptcha('Google is forcing a CAPTCHA. To get around this issue, run the google-alerts with the seed option to open an interactive authentication session. Once authenticated, the session is cached in the config directory, and clients created with credentials load it when given `session_store=FileSessionStore()`')
         cookies = [x.name for x in response.cookies]
         if 'SIDCC' not in cookies:
             raise InvalidCredentials("Email or password was incorrect.")
-        with open(SESSION_FILE, 'wb') as f:
-            cookies = requests.utils.dict_from_cookiejar(self._session.cookies)
-            pickle.dump(cookies, f, protocol=2)
-            self._log.debug("Saved session to disk for future reference")
-        self._log.debug("User successfully authenticated")
-        self._is_authenticated = True
-        self._process_state()
+        cookies = requests.utils.dict_from_cookiejar(self._session.cookies)
+        self._sessions.save(self._email, cookies)
+        self._log.debug("Saved session to the store for future reference")
+
+    def authenticate(self):
+        """Authenticate the user and setup our state.
+
+        Saved session cookies are tried first. When they are missing or
+        expired, the session store lock is taken before logging in. Whoever
+        gets the lock first performs the login while the rest wait, then find
+        the refreshed cookies in the store and use them instead of logging in
+        again.
+        """
+        with self._auth_lock:
+            cookies = self._sessions.load(self._email)
+            if self._session_check(cookies):
+                self._log.debug("[!] User has already authenticated")
+            else:
+                with self._sessions.lock(self._email):
+                    fresh = self._sessions.load(self._email)
+                    if fresh and fresh != cookies and \
+                            self._session_check(fresh):
+                        self._log.debug("Session was refreshed by another client")
+                    else:
+                        self._login()
+                        self._log.debug("User successfully authenticated")
+            self._is_authenticated = True
+            self._process_state()
         return
 
-    def list(self, term=None):
+    def list(self, term=None, max_age=None):
         """List alerts configured for the account.
 
+        When `max_age` is given, a state fetched within that many seconds is
+        used instead of downloading it again. The in-memory state is tried
+        first, then the snapshot of the state cache, which lets a client that
+        never authenticated read the monitors of the account. Otherwise, or
+        when both are too old, the state is fetched live.
+
+        Snapshots only exist when the client was created with a
+        `state_cache`, such as `FileStateCache`. By default nothing is
+        persisted and only the in-memory state can satisfy `max_age`.
+
         At the time of processing, here are several state examples:
 
         - ['062bc676ab9e9d9b:5a96b75728adb9d4:com:en:US', [None, None, ['email_aih_all', 'com', ['en', 'US'], None, None, None, False], None, 2, [[1, 'XXX@gmail.com', [], 1, 'en-US', 1, None, None, None, None, '7290377213681086747', None, None, 'AB2Xq4g1vxP5nJCT4SVMp8-8CeYubB7G0yQdZnM']]], '06449491676132715360']
@@ -335,16 +772,39 @@ class GoogleAlerts:
         - ['062bc676ab9e9d9b:a92eace4d0488209:com:en:US', [None, None, ['rss_aih_best', 'com', ['en', 'US'], None, None, None, False], None, 3, [[2, '', [], 1, 'en-US', 1, None, None, None, None, '10457927733922767031', None, None, 'AB2Xq4jZ1IPZLS44ZpaXYn8Fh46euu8_so_2k7k']]], '06449491676132715360']
         - ['062bc676ab9e9d9b:ac4752c338e8c363:com:en:US', [None, None, ['rss_all', 'com', ['en', 'US'], None, None, None, False], None, 2, [[2, '', [], 1, 'en-US', 1, None, None, None, None, '17387577876633356534', None, None, 'AB2Xq4h1wQcVxLfb0s835KmJWdw7bfUzzwpjUrg']]], '06449491676132715360']
         """
+        if max_age is not None:
+            state = self._cached_state(max_age)
+            if state is not None:
+                return self._parse_monitors(state, term)
         if not self._state:
             raise InvalidState("State was not properly obtained from the app")
-        self._process_state()
-        if not self._state[0]:
+        state = self._process_state()
+        return self._parse_monitors(state, term)
+
+    def _cached_state(self, max_age):
+        """Return a state no older than `max_age` seconds without fetching."""
+        with self._lock:
+            state, age = self._state, self.state_age()
+        if state and age is not None and age <= max_age:
+            self._log.debug("Using state from memory")
+            return state
+        if not self._state_cache:
+            return None
+        snapshot = self._state_cache.load(self._email)
+        if snapshot and time.time() - snapshot['fetched_at'] <= max_age:
+            self._log.debug("Using state snapshot from the cache")
+            return snapshot['state']
+        return None
+
+    def _parse_monitors(self, state, term=None):
+        """Turn the monitor rows of a state into monitor dicts."""
+        if not state[0]:
             self._log.info("No monitors have been created yet.")
             return list()
 
         monitors = list()
         try:
-            for monitor in self._state[0][0]:
+            for monitor in state[0][0]:
                 obj = dict()
                 obj['monitor_id'] = monitor[0]
                 obj['user_id'] = monitor[-1]
@@ -367,13 +827,74 @@ class GoogleAlerts:
             raise StateParseFailure("Observed state differs from parser. Please file a bug at https://github.com/9b/google-alerts/issues.")
         return monitors
 
+    def _decode_monitor(self, content, match):
+        """Find the monitor row returned by a create or modify call.
+
+        Responses may carry the usual `)]}'` guard before the JSON body. The
+        body is searched for a row that parses like the ones in the state and
+        satisfies `match`, which is given the parsed monitor.
+
+        :returns: Raw monitor row or None when the response cannot be decoded.
+        """
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        content = content.strip()
+        if content.startswith(")]}'"):
+            content = content[4:]
+        try:
+            data = json.loads(content)
+        except ValueError:
+            return None
+        pending = [data]
+        while pending:
+            item = pending.pop()
+            if not isinstance(item, list):
+                continue
+            if len(item) > 2 and isinstance(item[0], str) and \
+                    isinstance(item[1], list):
+                try:
+                    monitors = self._parse_monitors([[[item]]])
+                except StateParseFailure:
+                    monitors = None
+                if monitors and match(monitors[0]):
+                    return item
+            pending.extend(item)
+        return None
+
+    def _update_state(self, row=None, removed=None):
+        """Apply a monitor change to the in-memory state.
+
+        The state is copied along the path to the monitor rows and swapped in,
+        so snapshots handed out earlier stay untouched. A configured state
+        cache is updated as well.
+
+        :returns: Updated state.
+        """
+        with self._lock:
+            state = list(self._state)
+            rows = list(state[0][0]) if state[0] else list()
+            monitor_id = row[0] if row else removed
+            rows = [x for x in rows if x[0] != monitor_id]
+            if row:
+                rows.append(row)
+            state[0] = [rows] + list(state[0][1:] if state[0] else [])
+            self._state = state
+        self._save_state()
+        return state
+
     def create(self, term, options):
-        """Create a monitor using passed configuration."""
+        """Create a monitor using passed configuration.
+
+        The new monitor is read from the response and added to the state.
+        The state is only downloaded again when the response can't be decoded.
+        """
         if not self._state:
             raise InvalidState("State was not properly obtained from the app")
+        options = dict(options)
         options['action'] = 'CREATE'
-        payload = self._build_payload(term, options)
-        url = self.ALERTS_CREATE_URL.format(requestX=self._state[2])
+        request_x = self._state[2]
+        payload = self._build_payload(term, options, request_x)
+        url = self.ALERTS_CREATE_URL.format(requestX=request_x)
         self._log.debug("Creating alert using: %s" % url)
         params = json.dumps(payload, separators=(',', ':'))
         data = {'params': params}
@@ -383,10 +904,26 @@ class GoogleAlerts:
                               % response.content)
         if options.get('exact', False):
             term = "\"%s\"" % term
-        return self.list(term)
+        # Responses may echo existing monitors with the same term
+        with self._lock:
+            rows = self._state[0][0] if self._state[0] else []
+        known = set(x[0] for x in rows)
+        row = self._decode_monitor(
+            response.content,
+            lambda x: x['term'] == term and x['monitor_id'] not in known)
+        if row is None:
+            self._log.info("Create response could not be decoded, reloading "
+                           "state: %r" % response.content[:200])
+            return self.list(term)
+        return self._parse_monitors(self._update_state(row), term)
 
     def modify(self, monitor_id, options):
-        """Create a monitor using passed configuration."""
+        """Modify a monitor using passed configuration.
+
+        Settings that are not passed keep their current value. Like `create`,
+        the changed monitor is taken from the response when possible instead
+        of downloading the state again.
+        """
         if not self._state:
             raise InvalidState("State was not properly obtained from the app")
         monitors = self.list()  # Get the latest set of monitors
@@ -395,12 +932,18 @@ class GoogleAlerts:
             if monitor_id != monitor['monitor_id']:
                 continue
             obj = monitor
-        if not monitor_id:
-            raise MonitorNotFound("No monitor was found with that term.")
-        options['action'] = 'MODIFY'
-        options.update(obj)
-        payload = self._build_payload(obj['term'], options)
-        url = self.ALERTS_MODIFY_URL.format(requestX=self._state[2])
+        if not obj:
+            raise MonitorNotFound("No monitor was found with that ID.")
+        # Current settings first so the ones passed in take precedence
+        merged = dict(obj)
+        merged['monitor_match'] = obj['match_type']
+        merged.update(options)
+        merged['action'] = 'MODIFY'
+        merged['monitor_id'] = obj['monitor_id']
+        options = merged
+        request_x = self._state[2]
+        payload = self._build_payload(obj['term'], options, request_x)
+        url = self.ALERTS_MODIFY_URL.format(requestX=request_x)
         self._log.debug("Modifying alert using: %s" % url)
         params = json.dumps(payload, separators=(',', ':'))
         data = {'params': params}
@@ -408,7 +951,13 @@ class GoogleAlerts:
         if response.status_code != 200:
             raise ActionError("Failed to create monitor: %s"
                               % response.content)
-        return self.list()
+        row = self._decode_monitor(response.content,
+                                   lambda x: x['monitor_id'] == monitor_id)
+        if row is None:
+            self._log.info("Modify response could not be decoded, reloading "
+                           "state: %r" % response.content[:200])
+            return self.list()
+        return self._parse_monitors(self._update_state(row))
 
     def delete(self, monitor_id):
         """Delete a monitor by ID."""
@@ -431,6 +980,7 @@ class GoogleAlerts:
         if response.status_code != 200:
             raise ActionError("Failed to delete by ID: %s"
                               % response.content)
+        self._update_state(removed=monitor_id)
         return True
 
     def delete_by_term(self, term):
@@ -454,4 +1004,75 @@ class GoogleAlerts:
         if response.status_code != 200:
             raise ActionError("Failed to delete by term: %s"
                               % response.content)
+        self._update_state(removed=monitor_id)
         return True
+
+
+class PeriodicTask(threading.Thread):
+    """Daemon thread calling `tick` every `interval` seconds until stopped.
+
+    Failures are passed to `on_error`, or logged when no callback is given.
+    Can be used as a context manager, which starts and stops the thread.
+    """
+
+    failure = "Background task failed"
+
+    def __init__(self, name, interval, on_error=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.interval = interval
+        self.on_error = on_error
+        self._log = logging.getLogger(GoogleAlerts.NAME)
+        self._stopped = threading.Event()
+
+    def tick(self):
+        raise NotImplementedError
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
+                else:
+                    self._log.error("%s: %s" % (self.failure, e))
+
+    def stop(self, timeout=None):
+        """Stop the task and wait for the thread to exit."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def __enter__(self):
+        if not self.is_alive():
+            self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class StateRefresher(PeriodicTask):
+    """Keep the session and state of a client warm in the background.
+
+    Every `interval` seconds the client is refreshed unless its state was
+    already fetched within that window by a regular call. This way the first
+    call after a long idle period does not pay for revalidating the session
+    or fetching a new `requestX` token. Failures never propagate to the
+    caller's next request, they are passed to `on_error` instead, or logged
+    when no callback is given.
+    """
+
+    failure = "Background refresh failed"
+
+    def __init__(self, client, interval=600, on_error=None):
+        PeriodicTask.__init__(self, 'GoogleAlertsRefresher', interval,
+                              on_error)
+        self._client = client
+
+    def tick(self):
+        age = self._client.state_age()
+        if age is not None and age < self.interval:
+            return
+        self._client.refresh()
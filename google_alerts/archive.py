@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+"""Columnar archive of collected alert results, partitioned by day."""
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+from google_alerts import CONFIG_PATH, PeriodicTask, _atomic_write, _file_lock
+
+__author__ = "Brandon Dixon"
+__copyright__ = "Copyright, Brandon Dixon"
+__credits__ = ["Brandon Dixon"]
+__license__ = "MIT"
+__maintainer__ = "Brandon Dixon"
+__email__ = "brandon@9bplus.com"
+__status__ = "BETA"
+
+
+ARCHIVE_PATH = os.path.join(CONFIG_PATH, 'archive')
+MAGIC = b'GAC1'
+TRAILER = struct.Struct('<I4s')
+SEGMENT_SUFFIX = '.seg'
+NULL = -2 ** 63
+COLUMNS = (
+    ('id', 'str'),
+    ('monitor_id', 'dict'),
+    ('term', 'dict'),
+    ('url', 'str'),
+    ('title', 'str'),
+    ('published', 'int'),
+    ('cluster_id', 'int'),
+)
+TYPES = dict(COLUMNS)
+
+
+def partition_of(timestamp):
+    """Name of the day partition, `YYYY-MM-DD` in UTC, of a timestamp."""
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def _native(values, byteorder):
+    if byteorder != sys.byteorder:
+        values.byteswap()
+    return values
+
+
+def encode_column(kind, values):
+    """Encode the values of one column.
+
+    :returns: Tuple of the raw bytes and extra footer fields.
+    """
+    if kind == 'int':
+        data = array.array('q', [NULL if x is None else int(x)
+                                 for x in values])
+        return data.tobytes(), {}
+    if kind == 'dict':
+        dictionary = sorted(set(values), key=lambda x: (x is not None, x))
+        index = dict((x, i) for i, x in enumerate(dictionary))
+        data = array.array('I', [index[x] for x in values])
+        return data.tobytes(), {'values': dictionary}
+    encoded = [None if x is None else x.encode('utf-8') for x in values]
+    lengths = array.array('i', [-1 if x is None else len(x)
+                                for x in encoded])
+    return lengths.tobytes() + b''.join(x for x in encoded if x), {}
+
+
+def decode_column(kind, data, rows, footer, byteorder):
+    """Decode a column encoded by `encode_column` into a list."""
+    if kind == 'int':
+        values = _native(array.array('q', data), byteorder)
+        return [None if x == NULL else x for x in values]
+    if kind == 'dict':
+        dictionary = footer['values']
+        return [dictionary[x] for x in _native(array.array('I', data),
+                                               byteorder)]
+    lengths = array.array('i')
+    size = lengths.itemsize * rows
+    lengths.frombytes(data[:size])
+    _native(lengths, byteorder)
+    values = list()
+    position = size
+    for length in lengths:
+        if length < 0:
+            values.append(None)
+            continue
+        values.append(data[position:position + length].decode('utf-8'))
+        position += length
+    return values
+
+
+def write_segment(path, rows, replaces=None, level=6):
+    """Write rows to a segment file.
+
+    A segment starts with `MAGIC`, followed by one zlib block per column and
+    a JSON footer holding the offset of each block, the dictionaries of the
+    dictionary encoded columns, the range of `published` and the names of
+    the segments it replaces. The footer length and `MAGIC` close the file.
+    """
+    rows = sorted(rows, key=lambda x: (x.get('published') is not None,
+                                       x.get('published')))
+    published = [x['published'] for x in rows
+                 if x.get('published') is not None]
+    chunks = [MAGIC]
+    offset = len(MAGIC)
+    columns = dict()
+    for name, kind in COLUMNS:
+        raw, extra = encode_column(kind, [x.get(name) for x in rows])
+        block = zlib.compress(raw, level)
+        columns[name] = dict(extra, offset=offset, length=len(block))
+        chunks.append(block)
+        offset += len(block)
+    footer = json.dumps({
+        'version': 1,
+        'rows': len(rows),
+        'byteorder': sys.byteorder,
+        'min_published': min(published) if published else None,
+        'max_published': max(published) if published else None,
+        'replaces': sorted(replaces or []),
+        'columns': columns
+    }, separators=(',', ':')).encode('utf-8')
+    chunks.append(footer)
+    chunks.append(TRAILER.pack(len(footer), MAGIC))
+    _atomic_write(path, b''.join(chunks), 'wb')
+
+
+class Segment(object):
+    """Read access to one segment file through a memory map.
+
+    Only the footer is parsed when opening, columns are decompressed when
+    asked for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        length, magic = TRAILER.unpack(self._map[-TRAILER.size:])
+        if magic != MAGIC or self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("%s is not an archive segment." % path)
+        end = len(self._map) - TRAILER.size
+        self.footer = json.loads(self._map[end - length:end].decode('utf-8'))
+        self.rows = self.footer['rows']
+
+    def column(self, name):
+        """Decompress and decode one column."""
+        info = self.footer['columns'][name]
+        data = zlib.decompress(
+            self._map[info['offset']:info['offset'] + info['length']])
+        return decode_column(TYPES[name], data, self.rows, info,
+                             self.footer['byteorder'])
+
+    def overlaps(self, since=None, until=None):
+        """Whether the segment may hold rows in a time range."""
+        if since is None and until is None:
+            return True
+        low = self.footer['min_published']
+        high = self.footer['max_published']
+        if low is None:
+            return False
+        return (since is None or high >= since) and \
+            (until is None or low < until)
+
+    def has_any(self, name, wanted):
+        """Whether a dictionary encoded column holds any wanted value."""
+        return not wanted.isdisjoint(self.footer['columns'][name]['values'])
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _as_set(value):
+    if value is None:
+        return None
+    if isinstance(value, (list, set, tuple, frozenset)):
+        return set(value)
+    return set([value])
+
+
+class Archive(object):
+    """Append-only columnar store of alert entries.
+
+    Entries are buffered and written out as segment files under one
+    directory per day of publication (`YYYY-MM-DD`, UTC). Columns are
+    stored in separate zlib blocks so a scan only decompresses the columns
+    it returns or filters on, and partitions and segments outside the time
+    range, monitors or terms asked for are skipped without being read.
+
+    Every flush adds a segment, so frequent small flushes are merged by
+    `compact`, either explicitly or through `keep_compact` in the
+    background. Compaction writes the merged segment before removing the
+    old ones, and the merged segment lists what it replaces so readers never
+    see a row twice.
+
+    An instance can be passed to `FeedPoller` as a consumer.
+    """
+
+    def __init__(self, path=ARCHIVE_PATH, segment_rows=100000,
+                 buffer_rows=10000):
+        self.path = path
+        self.segment_rows = segment_rows
+        self.buffer_rows = buffer_rows
+        self._buffer = dict()
+        self._buffered = 0
+        self._lock = threading.Lock()
+
+    def add(self, entries):
+        """Buffer entries, writing segments once `buffer_rows` are held."""
+        with self._lock:
+            for entry in entries:
+                published = entry.get('published')
+                day = partition_of(time.time() if published is None
+                                   else published)
+                self._buffer.setdefault(day, []).append(
+                    dict((x, entry.get(x)) for x in TYPES))
+                self._buffered += 1
+            if self._buffered >= self.buffer_rows:
+                self._flush()
+
+    __call__ = add
+
+    def _segment_path(self, partition):
+        name = '%013d-%s%s' % (int(time.time() * 1000), uuid.uuid4().hex[:8],
+                               SEGMENT_SUFFIX)
+        return os.path.join(self.path, partition, name)
+
+    def _flush(self):
+        for partition, rows in sorted(self._buffer.items()):
+            for i in range(0, len(rows), self.segment_rows):
+                write_segment(self._segment_path(partition),
+                              rows[i:i + self.segment_rows])
+        self._buffer = dict()
+        self._buffered = 0
+
+    def flush(self):
+        """Write buffered entries out as segments."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def partitions(self, since=None, until=None):
+        """Day partitions that may hold entries in a time range."""
+        if not os.path.isdir(self.path):
+            return list()
+        first = partition_of(since) if since is not None else None
+        last = partition_of(until) if until is not None else None
+        days = list()
+        for name in sorted(os.listdir(self.path)):
+            if not os.path.isdir(os.path.join(self.path, name)):
+                continue
+            if (first and name < first) or (last and name > last):
+                continue
+            days.append(name)
+        return days
+
+    def _open_segments(self, partition):
+        """Open the live segments of a partition.
+
+        Segments replaced by a compacted one are skipped. When a segment
+        disappears while opening, a compaction just finished and the listing
+        is read again.
+        """
+        directory = os.path.join(self.path, partition)
+        while True:
+            try:
+                names = sorted(x for x in os.listdir(directory)
+                               if x.endswith(SEGMENT_SUFFIX))
+            except OSError:
+                return list()
+            segments = list()
+            try:
+                for name in names:
+                    path = os.path.join(directory, name)
+                    segments.append(Segment(path))
+            except (IOError, OSError):
+                for segment in segments:
+                    segment.close()
+                if os.path.exists(path):
+                    raise
+                continue
+            replaced = set()
+            for segment in segments:
+                replaced.update(segment.footer['replaces'])
+            live = list()
+            for segment in segments:
+                if segment.name in replaced:
+                    segment.close()
+                else:
+                    live.append(segment)
+            return live
+
+    def scan(self, columns=None, since=None, until=None, monitor_id=None,
+             term=None):
+        """Yield archived entries as dicts, oldest first in each segment.
+
+        :param columns: Names of the columns to return, all by default.
+        :param since: Only entries published at or after this epoch time.
+        :param until: Only entries published before this epoch time.
+        :param monitor_id: A monitor ID or a list of them.
+        :param term: A term or a list of them.
+        """
+        columns = list(columns or TYPES)
+        for name in columns:
+            if name not in TYPES:
+                raise ValueError("Unknown column: %s" % name)
+        filters = [('monitor_id', _as_set(monitor_id)),
+                   ('term', _as_set(term))]
+        filters = [(k, v) for k, v in filters if v is not None]
+        for partition in self.partitions(since, until):
+            for segment in self._open_segments(partition):
+                with segment:
+                    if not segment.overlaps(since, until) or \
+                            not all(segment.has_any(k, v)
+                                    for k, v in filters):
+                        continue
+                    selected = range(segment.rows)
+                    if since is not None or until is not None:
+                        published = segment.column('published')
+                        selected = [i for i in selected
+                                    if published[i] is not None and
+                                    (since is None or published[i] >= since)
+                                    and (until is None or
+                                         published[i] < until)]
+                    for name, wanted in filters:
+                        values = segment.column(name)
+                        selected = [i for i in selected
+                                    if values[i] in wanted]
+                    if not selected:
+                        continue
+                    data = [(x, segment.column(x)) for x in columns]
+                    for i in selected:
+                        yield dict((name, values[i]) for name, values in data)
+
+    def count(self, since=None, until=None, monitor_id=None, term=None):
+        """Number of archived entries matching the filters."""
+        return sum(1 for _ in self.scan(['published'], since, until,
+                                        monitor_id, term))
+
+    def _compact_partition(self, partition, small_rows):
+        merged = 0
+        segments = self._open_segments(partition)
+        try:
+            small = [x for x in segments if x.rows < small_rows]
+            groups = list()
+            group = list()
+            rows = 0
+            for segment in small:
+                if group and rows + segment.rows > self.segment_rows:
+                    groups.append(group)
+                    group, rows = list(), 0
+                group.append(segment)
+                rows += segment.rows
+            groups.append(group)
+            for group in groups:
+                if len(group) < 2:
+                    continue
+                data = list()
+                for segment in group:
+                    columns = [(x, segment.column(x)) for x in TYPES]
+                    data.extend(dict((name, values[i])
+                                     for name, values in columns)
+                                for i in range(segment.rows))
+                write_segment(self._segment_path(partition), data,
+                              [x.name for x in group], level=9)
+                for segment in group:
+                    os.remove(segment.path)
+                merged += len(group)
+        finally:
+            for segment in segments:
+                segment.close()
+        return merged
+
+    def _remove_replaced(self, partition):
+        """Delete segments left behind by an interrupted compaction."""
+        replaced = set()
+        for segment in self._open_segments(partition):
+            replaced.update(segment.footer['replaces'])
+            segment.close()
+        directory = os.path.join(self.path, partition)
+        for name in replaced:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def compact(self, partition=None, small_rows=None):
+        """Merge small segments into segments of up to `segment_rows`.
+
+        :param partition: Only compact this day, every day by default.
+        :param small_rows: Segments below this many rows are merged, half of
+            `segment_rows` by default.
+        :returns: Number of segments that were merged away.
+        """
+        small_rows = small_rows or self.segment_rows // 2
+        partitions = [partition] if partition else self.partitions()
+        merged = 0
+        with _file_lock(os.path.join(self.path, 'compact')):
+            for name in partitions:
+                self._remove_replaced(name)
+                merged += self._compact_partition(name, small_rows)
+        return merged
+
+    def keep_compact(self, interval=3600, on_error=None):
+        """Start compacting in a background thread.
+
+        :returns: The running `Compactor`; call `stop()` when done.
+        """
+        compactor = Compactor(self, interval, on_error)
+        compactor.start()
+        return compactor
+
+
+class Compactor(PeriodicTask):
+    """Compact an archive every `interval` seconds in the background.
+
+    Failures are passed to `on_error`, or logged when no callback is given.
+    """
+
+    failure = "Background compaction failed"
+
+    def __init__(self, archive, interval=3600, on_error=None):
+        PeriodicTask.__init__(self, 'GoogleAlertsCompactor', interval,
+                              on_error)
+        self._archive = archive
+
+    def tick(self):
+        self._archive.compact()
@@ -1,17 +1,24 @@
 #!/usr/bin/env python
 """Perform administrative actions on Google Alerts."""
-import base64
 import contextlib
 import json
 import os
-import pickle
 import sys
+import threading
 import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 import selenium.webdriver as webdriver
 
-from google_alerts import GoogleAlerts
+from google_alerts import (FileConfig, FileSessionStore, FileStateCache,
+                           GoogleAlerts, InvalidState)
+from google_alerts.archive import Archive
+from google_alerts.feeds import FeedPoller
+from google_alerts.mail import MailReader
+from google_alerts.planner import PLAN_FILE, QueryPlanner, TermMap, apply_plan
+from google_alerts.sinks import sink_from_spec
+from google_alerts.stats import DAY, STATS_FILE, Stats
 
 PY2 = False
 if sys.version_info[0] < 3:
@@ -29,38 +36,117 @@ __status__ = "BETA"
 AUTH_COOKIE_NAME = 'SIDCC'
 CONFIG_PATH = os.path.expanduser('~/.config/google_alerts')
 CONFIG_FILE = os.path.join(CONFIG_PATH, 'config.json')
-SESSION_FILE = os.path.join(CONFIG_PATH, 'session')
-CONFIG_DEFAULTS = {'email': '', 'password': '', 'py2': PY2}
 
 
-def obfuscate(p, action):
-    """Obfuscate the auth details to avoid easy snatching.
+def build_client(config):
+    """Create a client sharing sessions and state snapshots on disk."""
+    return GoogleAlerts(config['email'], config['password'],
+                        session_store=FileSessionStore(CONFIG_PATH),
+                        state_cache=FileStateCache(CONFIG_PATH))
 
-    It's best to use a throw away account for these alerts to avoid having
-    your authentication put at risk by storing it locally.
+
+def read_operations(stream):
+    """Yield batch operations from a stream of JSON lines.
+
+    Blank lines and lines starting with `#` are skipped. Lines that fail to
+    decode are yielded as an exception so they can be reported in order with
+    the rest of the results instead of aborting the batch.
     """
-    key = "ru7sll3uQrGtDPcIW3okutpFLo6YYtd5bWSpbZJIopYQ0Du0a1WlhvJOaZEH"
-    s = list()
-    if action == 'store':
-        if PY2:
-            for i in range(len(p)):
-                kc = key[i % len(key)]
-                ec = chr((ord(p[i]) + ord(kc)) % 256)
-                s.append(ec)
-            return base64.urlsafe_b64encode("".join(s))
-        else:
-            return base64.urlsafe_b64encode(p.encode()).decode()
-    else:
-        if PY2:
-            e = base64.urlsafe_b64decode(p)
-            for i in range(len(e)):
-                kc = key[i % len(key)]
-                dc = chr((256 + ord(e[i]) - ord(kc)) % 256)
-                s.append(dc)
-            return "".join(s)
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            operation = json.loads(line)
+            if not isinstance(operation, dict):
+                raise ValueError("Operation must be a JSON object.")
+        except ValueError as e:
+            yield number, e
+            continue
+        yield number, operation
+
+
+def run_operation(ga, operation):
+    """Run a single batch operation against an authenticated client.
+
+    Supported actions are `create` (term, options), `modify` (monitor_id,
+    options) and `delete` (monitor_id or term).
+    """
+    action = str(operation.get('action', '')).lower()
+    options = dict(operation.get('options', {}))
+    if action == 'create':
+        return ga.create(operation['term'], options)
+    if action == 'modify':
+        return ga.modify(operation['monitor_id'], options)
+    if action == 'delete':
+        if operation.get('monitor_id'):
+            return ga.delete(operation['monitor_id'])
+        return ga.delete_by_term(operation['term'])
+    raise ValueError("Unknown action: %s" % operation.get('action'))
+
+
+def read_terms(stream):
+    """Read planner terms from JSON lines or plain lines of text.
+
+    A line is either a term or a JSON object with a `term` and optionally
+    its `options` and expected `volume`.
+    """
+    terms = list()
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            terms.append(json.loads(line))
         else:
-            e = base64.urlsafe_b64decode(p)
-            return e.decode()
+            terms.append(line)
+    return terms
+
+
+def run_batch(ga, stream, concurrency=1, output=sys.stdout):
+    """Execute a stream of operations, emitting one result line per operation.
+
+    Results are written as soon as each operation completes, so the order of
+    the output follows completion and not the input. Every result carries the
+    input line number and the optional `id` field of the operation so callers
+    can correlate them. Only a bounded number of operations are read ahead of
+    the workers, which keeps memory flat for very large inputs. The client
+    is shared by all of the workers.
+    """
+    def execute(number, operation):
+        result = {'line': number, 'status': 'ok'}
+        if isinstance(operation, Exception):
+            result.update({'status': 'error', 'error': str(operation)})
+            return result
+        result['id'] = operation.get('id')
+        result['action'] = operation.get('action')
+        try:
+            result['result'] = run_operation(ga, operation)
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = "%s: %s" % (e.__class__.__name__, e)
+        return result
+
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    failures = [0]
+
+    def emit(future):
+        # Written from the worker as it finishes, never waiting on input
+        result = future.result()
+        with lock:
+            if result['status'] != 'ok':
+                failures[0] += 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for number, operation in read_operations(stream):
+            slots.acquire()
+            future = executor.submit(execute, number, operation)
+            future.add_done_callback(emit)
+    return failures[0]
 
 
 def main():
@@ -79,6 +165,10 @@ def main():
     setup_parser.add_argument('-t', '--timeout', dest='timeout',
                               required=False, type=int, default=20)
     setup_parser = subs.add_parser('list')
+    setup_parser.add_argument('--cached', dest='cached', action='store_true',
+                              help='Serve from the last saved state without any network access.')
+    setup_parser.add_argument('--max-age', dest='max_age', type=int,
+                              help='Use the saved state if it is younger than this many seconds.')
     setup_parser = subs.add_parser('create')
     setup_parser.add_argument('-t', '--term', dest='term', required=True,
                               help='Term to store.', type=str)
@@ -94,28 +184,61 @@ def main():
     setup_parser.add_argument('--id', dest='term_id', required=True,
                               help='ID of the term to find for deletion.',
                               type=str)
+    setup_parser = subs.add_parser('batch')
+    setup_parser.add_argument('-i', '--input', dest='input', default='-',
+                              help='File of JSON operations, one per line. Defaults to stdin.',
+                              type=str)
+    setup_parser.add_argument('-c', '--concurrency', dest='concurrency',
+                              default=1, type=int,
+                              help='Number of operations to run at once.')
+    setup_parser = subs.add_parser('poll')
+    setup_parser.add_argument('-i', '--interval', dest='interval', default=300,
+                              type=int, help='Seconds between polls.')
+    setup_parser.add_argument('-n', '--iterations', dest='iterations',
+                              type=int, help='Number of polls, forever by default.')
+    setup_parser.add_argument('-s', '--sink', dest='sinks', action='append',
+                              help='Where to send new results: - for stdout, a file, unix:<path> or an http(s) URL. Can be repeated.')
+    setup_parser.add_argument('--dead-letter', dest='dead_letter',
+                              help='File to keep results that could not be delivered.')
+    setup_parser.add_argument('--archive', dest='archive',
+                              help='Directory of a columnar archive to append results to.')
+    setup_parser = subs.add_parser('plan')
+    setup_parser.add_argument('-i', '--input', dest='input', default='-',
+                              help='File of terms, one per line as text or JSON. Defaults to stdin.',
+                              type=str)
+    setup_parser.add_argument('-d', '--delivery', dest='delivery',
+                              default='rss', choices=['rss', 'mail'],
+                              help='Delivery of terms that do not set one.')
+    setup_parser.add_argument('--max-length', dest='max_length', default=256,
+                              type=int, help='Longest query to create.')
+    setup_parser.add_argument('--max-volume', dest='max_volume',
+                              default=20.0, type=float,
+                              help='Most expected new results a day per monitor.')
+    setup_parser.add_argument('--apply', dest='apply', action='store_true',
+                              help='Create and delete monitors to match the plan.')
+    setup_parser = subs.add_parser('mail')
+    setup_parser.add_argument('-p', '--path', dest='path', required=True,
+                              help='Mbox file or Maildir holding alert emails.')
+    setup_parser.add_argument('-s', '--sink', dest='sinks', action='append',
+                              help='Where to send results: - for stdout, a file, unix:<path> or an http(s) URL. Can be repeated.')
+    setup_parser = subs.add_parser('stats')
+    setup_parser.add_argument('--days', dest='days', default=7, type=int,
+                              help='Number of days to summarize.')
+    setup_parser.add_argument('--recommend', dest='recommend',
+                              action='store_true',
+                              help='Suggest monitor changes from the stats.')
     args = parser.parse_args()
 
     if args.cmd == 'setup':
-        if not os.path.exists(CONFIG_PATH):
-            os.makedirs(CONFIG_PATH)
-        if not os.path.exists(CONFIG_FILE):
-            json.dump(CONFIG_DEFAULTS, open(CONFIG_FILE, 'w'), indent=4,
-                      separators=(',', ': '))
-        config = CONFIG_DEFAULTS
-        config['email'] = args.email
-        config['password'] = str(obfuscate(args.pwd, 'store'))
-        json.dump(config, open(CONFIG_FILE, 'w'), indent=4,
-                  separators=(',', ': '))
-
-    config = json.load(open(CONFIG_FILE))
-    if config.get('py2', PY2) != PY2:
-        raise Exception("Python versions have changed. Please run `setup` again to reconfigure the client.")
-    if config['password'] == '':
+        FileConfig(CONFIG_FILE, persist=True).save(args.email, args.pwd)
+
+    config = FileConfig(CONFIG_FILE).load()
+    # Saved snapshots are keyed by account, reading them needs no password
+    offline = args.cmd == 'list' and args.cached
+    if config['email'] == '' or (config['password'] == '' and not offline):
         raise Exception("Run setup before any other actions!")
 
     if args.cmd == 'seed':
-        config['password'] = obfuscate(str(config['password']), 'fetch')
         ga = GoogleAlerts(config['email'], config['password'])
         chrome_options = webdriver.ChromeOptions()
         chrome_options.add_experimental_option("excludeSwitches", ['enable-automation'])
@@ -142,19 +265,29 @@ def main():
             collected = dict()
             for cookie in cookies:
                 collected[str(cookie['name'])] = str(cookie['value'])
-            with open(SESSION_FILE, 'wb') as f:
-                pickle.dump(collected, f, protocol=2)
+            FileSessionStore(CONFIG_PATH).save(config['email'], collected)
         print("[$] Session has been seeded, google-alerts is ready for use.")
 
     if args.cmd == 'list':
-        config['password'] = obfuscate(str(config['password']), 'fetch')
-        ga = GoogleAlerts(config['email'], config['password'])
-        ga.authenticate()
-        print(json.dumps(ga.list(), indent=4))
+        ga = build_client(config)
+        if args.cached:
+            try:
+                monitors = ga.list(max_age=float('inf'))
+            except InvalidState:
+                raise Exception("No saved state yet, run `list` without --cached first.")
+        elif args.max_age is not None:
+            try:
+                monitors = ga.list(max_age=args.max_age)
+            except InvalidState:
+                ga.authenticate()
+                monitors = ga.list(max_age=args.max_age)
+        else:
+            ga.authenticate()
+            monitors = ga.list()
+        print(json.dumps(monitors, indent=4))
 
     if args.cmd == 'create':
-        config['password'] = obfuscate(str(config['password']), 'fetch')
-        ga = GoogleAlerts(config['email'], config['password'])
+        ga = build_client(config)
         ga.authenticate()
 
         # 'realtime' is default, force it
@@ -171,13 +304,129 @@ def main():
         print(json.dumps(monitor, indent=4))
 
     if args.cmd == 'delete':
-        config['password'] = obfuscate(str(config['password']), 'fetch')
-        ga = GoogleAlerts(config['email'], config['password'])
+        ga = build_client(config)
         ga.authenticate()
         result = ga.delete(args.term_id)
         if result:
             print("%s was deleted" % args.term_id)
 
+    if args.cmd == 'batch':
+        if args.concurrency < 1:
+            raise Exception("Concurrency must be at least 1.")
+        ga = build_client(config)
+        # Results go to stdout, keep the logs quiet and out of the way
+        ga.set_log_level('error')
+        ga.set_log_stream(sys.stderr)
+        ga.authenticate()
+        if args.input == '-':
+            failures = run_batch(ga, sys.stdin, args.concurrency)
+        else:
+            with open(args.input) as f:
+                failures = run_batch(ga, f, args.concurrency)
+        if failures:
+            sys.exit(1)
+
+    if args.cmd == 'poll':
+        ga = build_client(config)
+        # Results go to stdout, keep the logs quiet and out of the way
+        ga.set_log_level('error')
+        ga.set_log_stream(sys.stderr)
+        ga.authenticate()
+        stats = Stats.load(STATS_FILE)
+        sinks = [sink_from_spec(x, dead_letter=args.dead_letter)
+                 for x in args.sinks or ['-']]
+        archive = compactor = None
+        if args.archive:
+            archive = Archive(args.archive)
+            compactor = archive.keep_compact()
+            sinks.append(archive)
+        term_map = TermMap.load(PLAN_FILE)
+        consumers = sinks
+        if term_map.monitors():
+            consumers = [term_map.consumer(sinks)]
+        poller = FeedPoller(ga.list(), consumers=consumers, stats=stats)
+        count = 0
+        try:
+            while args.iterations is None or count < args.iterations:
+                started = time.time()
+                poller.poll()
+                stats.save(STATS_FILE)
+                if archive:
+                    archive.flush()
+                count += 1
+                if args.iterations is None or count < args.iterations:
+                    time.sleep(max(0, args.interval - (time.time() - started)))
+        finally:
+            if compactor:
+                compactor.stop()
+            for sink in sinks:
+                sink.close()
+
+    if args.cmd == 'plan':
+        if args.input == '-':
+            terms = read_terms(sys.stdin)
+        else:
+            with open(args.input) as f:
+                terms = read_terms(f)
+        planner = QueryPlanner(max_length=args.max_length,
+                               max_volume=args.max_volume)
+        plan = planner.plan(terms, {'delivery': args.delivery.upper()},
+                            Stats.load(STATS_FILE))
+        if not args.apply:
+            print(json.dumps(plan, indent=4))
+            return
+        ga = build_client(config)
+        ga.authenticate()
+        # The map is updated as monitors change, keep it even on failure
+        term_map = TermMap.load(PLAN_FILE)
+        try:
+            _, actions = apply_plan(ga, plan, term_map)
+        finally:
+            term_map.save(PLAN_FILE)
+        print(json.dumps(actions, indent=4))
+
+    if args.cmd == 'mail':
+        ga = build_client(config)
+        # Results go to stdout, keep the logs quiet and out of the way
+        ga.set_log_level('error')
+        ga.set_log_stream(sys.stderr)
+        try:
+            monitors = ga.list(max_age=DAY)
+        except InvalidState:
+            ga.authenticate()
+            monitors = ga.list(max_age=DAY)
+        stats = Stats.load(STATS_FILE)
+        sinks = [sink_from_spec(x) for x in args.sinks or ['-']]
+        reader = MailReader(monitors, stats=stats)
+        batch = list()
+        try:
+            for entry in reader.read(os.path.expanduser(args.path)):
+                batch.append(entry)
+                if len(batch) >= 500:
+                    for sink in sinks:
+                        sink.submit(batch)
+                    batch = list()
+            for sink in sinks:
+                sink.submit(batch)
+        finally:
+            for sink in sinks:
+                sink.close()
+        stats.save(STATS_FILE)
+
+    if args.cmd == 'stats':
+        stats = Stats.load(STATS_FILE)
+        window = args.days * DAY
+        if not args.recommend:
+            print(json.dumps(stats.summary(window), indent=4))
+            return
+        ga = build_client(config)
+        try:
+            monitors = ga.list(max_age=DAY)
+        except InvalidState:
+            ga.authenticate()
+            monitors = ga.list(max_age=DAY)
+        print(json.dumps(stats.recommend(monitors, window), indent=4))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""Group near-duplicate alert results into stories."""
+import collections
+import hashlib
+import random
+import re
+import threading
+
+__author__ = "Brandon Dixon"
+__copyright__ = "Copyright, Brandon Dixon"
+__credits__ = ["Brandon Dixon"]
+__license__ = "MIT"
+__maintainer__ = "Brandon Dixon"
+__email__ = "brandon@9bplus.com"
+__status__ = "BETA"
+
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+PRIME = (1 << 61) - 1
+
+
+def features(text):
+    """Return the set of words in a text."""
+    return set(WORDS.findall(text.lower()))
+
+
+def permutations(count, seed=1):
+    """Return the hash permutations used to build signatures."""
+    rand = random.Random(seed)
+    return [(rand.randrange(1, PRIME), rand.randrange(PRIME))
+            for _ in range(count)]
+
+
+def minhash(text, perms):
+    """Compute the MinHash signature of the words of a text.
+
+    The share of positions two signatures agree on estimates the Jaccard
+    similarity of the word sets. Texts without any word have no signature
+    and None is returned.
+    """
+    hashes = [int(hashlib.md5(x.encode('utf-8')).hexdigest()[:15], 16)
+              for x in features(text)]
+    if not hashes:
+        return None
+    return tuple(min((a * h + b) % PRIME for h in hashes) for a, b in perms)
+
+
+def stable_id(entry):
+    """Cluster ID derived from the entry that starts a cluster.
+
+    IDs are 60 bit integers hashed from the URL, or the entry ID, so they
+    stay the same across restarts and fit 64 bit integer columns.
+    """
+    key = entry.get('url') or entry.get('id') or \
+        '%s %s' % (entry.get('title', ''), entry.get('snippet', ''))
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def similarity(a, b):
+    """Estimate the Jaccard similarity of two signatures."""
+    return sum(1 for x, y in zip(a, b) if x == y) / float(len(a))
+
+
+class Clusterer(object):
+    """Incrementally cluster entries by the MinHash of title and snippet.
+
+    Signatures are split into `bands` bands and entries sharing one band
+    exactly become candidates, confirmed when their estimated similarity
+    reaches `threshold`. Each band value points to a short list of recent
+    signatures, which keeps the work per entry roughly constant no matter
+    how many entries were seen. Entries with the same canonical URL always
+    land in the same cluster. Entries without any words in their title and
+    snippet are only grouped by URL.
+
+    Cluster IDs come from `stable_id` and do not change between runs. Only
+    the `max_clusters` most recently updated clusters are kept, and each
+    one only indexes the signatures of its representative and of its
+    `member_signatures` latest members, so memory stays bounded however
+    large a story grows.
+    """
+
+    def __init__(self, threshold=0.6, num_perm=64, bands=16,
+                 max_clusters=100000, bucket_size=16, member_signatures=4):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands.")
+        self.threshold = threshold
+        self.max_clusters = max_clusters
+        self.bucket_size = bucket_size
+        self.member_signatures = member_signatures
+        self._perms = permutations(num_perm)
+        self._bands = bands
+        self._rows = num_perm // bands
+        self._buckets = dict()
+        self._clusters = collections.OrderedDict()
+        self._signatures = dict()
+        self._urls = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _band_keys(self, signature):
+        return [(i, signature[i * self._rows:(i + 1) * self._rows])
+                for i in range(self._bands)]
+
+    def _match(self, entry, signature):
+        cluster_id = self._urls.get(entry.get('url'))
+        if cluster_id in self._clusters:
+            return cluster_id
+        if signature is None:
+            return None
+        for key in self._band_keys(signature):
+            for candidate, cluster_id in self._buckets.get(key, ()):
+                if cluster_id not in self._clusters:
+                    continue
+                if similarity(candidate, signature) >= self.threshold:
+                    return cluster_id
+        return None
+
+    def _remember(self, entry, signature, cluster_id):
+        signatures = self._signatures.setdefault(cluster_id, [])
+        if signature is not None and signature not in signatures:
+            for key in self._band_keys(signature):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = collections.deque(
+                        maxlen=self.bucket_size)
+                bucket.append((signature, cluster_id))
+            signatures.append(signature)
+            # Keep the representative and the most recent members
+            if len(signatures) > self.member_signatures + 1:
+                self._forget(signatures.pop(1), cluster_id)
+        if entry.get('url'):
+            self._urls[entry['url']] = cluster_id
+            if len(self._urls) > self.max_clusters * 4:
+                self._urls.popitem(last=False)
+
+    def _forget(self, signature, cluster_id):
+        """Drop a signature of a cluster from its band buckets."""
+        for key in self._band_keys(signature):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            kept = [x for x in bucket
+                    if x[1] != cluster_id or x[0] != signature]
+            if kept:
+                self._buckets[key] = collections.deque(
+                    kept, maxlen=self.bucket_size)
+            else:
+                del self._buckets[key]
+
+    def _evict(self):
+        cluster_id, _ = self._clusters.popitem(last=False)
+        for signature in self._signatures.pop(cluster_id, ()):
+            self._forget(signature, cluster_id)
+
+    def assign(self, entry):
+        """Place one entry in a cluster.
+
+        The entry gets a `cluster_id` key.
+
+        :returns: Tuple of the cluster and whether it was just created.
+        """
+        text = '%s %s' % (entry.get('title', ''), entry.get('snippet', ''))
+        signature = minhash(text, self._perms)
+        with self._lock:
+            cluster_id = self._match(entry, signature)
+            if cluster_id is None:
+                cluster_id = stable_id(entry)
+            created = cluster_id not in self._clusters
+            if created:
+                self._clusters[cluster_id] = {
+                    'cluster_id': cluster_id,
+                    'representative': entry,
+                    'monitor_ids': set(),
+                    'terms': set(),
+                    'size': 0
+                }
+                if len(self._clusters) > self.max_clusters:
+                    self._evict()
+            else:
+                self._clusters.move_to_end(cluster_id)
+            cluster = self._clusters[cluster_id]
+            cluster['size'] += 1
+            cluster['monitor_ids'].add(entry.get('monitor_id'))
+            cluster['terms'].add(entry.get('term'))
+            self._remember(entry, signature, cluster_id)
+        entry['cluster_id'] = cluster_id
+        return cluster, created
+
+    def add(self, entries):
+        """Cluster a batch of entries.
+
+        Works as a `FeedPoller` consumer. Consumers placed after it see the
+        `cluster_id` on every entry.
+
+        :returns: Entries that started a new cluster, one per story.
+        """
+        return [x for x in entries if self.assign(x)[1]]
+
+    __call__ = add
+
+    def consumer(self, consumers):
+        """Wrap consumers so they only receive one entry per story.
+
+        The result can be given to `FeedPoller` in place of the consumers.
+        """
+        def consume(entries):
+            entries = self.add(entries)
+            if not entries:
+                return
+            for consumer in consumers:
+                consumer(entries)
+        return consume
+
+    def get(self, cluster_id):
+        """Return a cluster by ID or None once it was evicted."""
+        return self._clusters.get(cluster_id)
+
+    def clusters(self, min_size=1):
+        """Return the clusters kept, oldest first."""
+        with self._lock:
+            return [x for x in self._clusters.values()
+                    if x['size'] >= min_size]
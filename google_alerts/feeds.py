@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Collect alert results from the RSS feeds of monitors."""
+import calendar
+import collections
+import hashlib
+import logging
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+
+import requests
+
+from google_alerts import GoogleAlerts
+
+try:
+    from html import unescape
+    from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+except ImportError:
+    from HTMLParser import HTMLParser
+    from urllib import urlencode
+    from urlparse import parse_qs, urlsplit, urlunsplit
+    unescape = HTMLParser().unescape
+
+__author__ = "Brandon Dixon"
+__copyright__ = "Copyright, Brandon Dixon"
+__credits__ = ["Brandon Dixon"]
+__license__ = "MIT"
+__maintainer__ = "Brandon Dixon"
+__email__ = "brandon@9bplus.com"
+__status__ = "BETA"
+
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+TAGS = re.compile(r'<[^>]+>')
+TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid')
+
+
+def clean_text(value):
+    """Strip markup and entities from feed text."""
+    if not value:
+        return ''
+    return ' '.join(unescape(TAGS.sub('', value)).split())
+
+
+def unwrap_url(url):
+    """Return the canonical target of a Google redirect link.
+
+    Alert results point at `google.com/url?...&url=<target>`. The target is
+    pulled out, the scheme and host are lowercased, and fragments and common
+    tracking parameters are dropped so the same article always maps to the
+    same URL.
+    """
+    parts = urlsplit(url)
+    if parts.netloc.endswith('google.com') and parts.path == '/url':
+        query = parse_qs(parts.query)
+        target = (query.get('url') or query.get('q') or [url])[0]
+        parts = urlsplit(target)
+    query = ''
+    if parts.query:
+        query = urlencode(sorted(
+            (k, v) for k, values in parse_qs(parts.query).items()
+            for v in values if not k.startswith(TRACKING_PARAMS)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path or '/', query, ''))
+
+
+def parse_time(value):
+    """Convert an RFC 3339 timestamp to epoch seconds."""
+    if not value:
+        return None
+    value = re.sub(r'\.\d+', '', value.strip())
+    offset = 0
+    match = re.search(r'([+-])(\d\d):?(\d\d)$', value)
+    if match:
+        offset = (int(match.group(2)) * 60 + int(match.group(3))) * 60
+        if match.group(1) == '-':
+            offset = -offset
+        value = value[:match.start()]
+    value = value.rstrip('Z')
+    try:
+        parsed = time.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+    return calendar.timegm(parsed) - offset
+
+
+def entry_id(monitor_id, url):
+    """Build an entry ID for results that do not come with one."""
+    key = '%s|%s' % (monitor_id, url)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def parse_feed(content, monitor):
+    """Parse the Atom feed of a monitor into entries.
+
+    Every entry is a dict with `id`, `monitor_id`, `term`, `title`,
+    `snippet`, `url` and `published` (epoch seconds).
+    """
+    root = ElementTree.fromstring(content)
+    entries = list()
+    for item in root.iter(ATOM + 'entry'):
+        link = item.find(ATOM + 'link')
+        if link is None or not link.get('href'):
+            continue
+        url = unwrap_url(link.get('href'))
+        published = item.findtext(ATOM + 'published') or \
+            item.findtext(ATOM + 'updated')
+        entries.append({
+            'id': item.findtext(ATOM + 'id') or
+            entry_id(monitor['monitor_id'], url),
+            'monitor_id': monitor['monitor_id'],
+            'term': monitor['term'],
+            'title': clean_text(item.findtext(ATOM + 'title')),
+            'snippet': clean_text(item.findtext(ATOM + 'content')),
+            'url': url,
+            'published': parse_time(published)
+        })
+    return entries
+
+
+def fetch_feed(monitor, session=None, timeout=30):
+    """Download and parse the feed of an RSS monitor."""
+    session = session or requests
+    response = session.get(monitor['rss_link'], headers=GoogleAlerts.HEADERS,
+                           timeout=timeout)
+    response.raise_for_status()
+    return parse_feed(response.content, monitor)
+
+
+class FeedPoller(object):
+    """Poll the feeds of a set of monitors and hand off new entries.
+
+    Feeds repeat entries between polls, so the IDs of recently seen entries
+    are remembered (up to `seen_limit`) and only new ones are passed to the
+    consumers. A consumer is any callable accepting a list of entries, for
+    example `SearchIndex.add`.
+
+    A feed that fails to download or parse does not stop the others. The
+    error goes to `on_error` with the monitor, or is logged when no callback
+    is given. With `stats`, every fetch is recorded in a `Stats` instance.
+    """
+
+    def __init__(self, monitors, consumers=None, session=None, timeout=30,
+                 seen_limit=100000, stats=None, on_error=None):
+        self.monitors = [x for x in monitors if x.get('rss_link')]
+        self.consumers = list(consumers or [])
+        self.timeout = timeout
+        self.stats = stats
+        self.on_error = on_error
+        self._log = logging.getLogger(GoogleAlerts.NAME)
+        self._session = session or requests.session()
+        self._seen = collections.OrderedDict()
+        self._seen_limit = seen_limit
+
+    def _is_new(self, entry):
+        if entry['id'] in self._seen:
+            return False
+        self._seen[entry['id']] = True
+        if len(self._seen) > self._seen_limit:
+            self._seen.popitem(last=False)
+        return True
+
+    def poll_monitor(self, monitor):
+        """Fetch one monitor and return its new entries."""
+        started = time.time()
+        try:
+            entries = fetch_feed(monitor, self._session, self.timeout)
+        except Exception as e:
+            if self.stats:
+                response = getattr(e, 'response', None)
+                status = getattr(response, 'status_code', None) or \
+                    e.__class__.__name__
+                self.stats.record_fetch(monitor, time.time() - started,
+                                        status)
+            raise
+        new = [x for x in entries if self._is_new(x)]
+        if self.stats:
+            self.stats.record_fetch(monitor, time.time() - started, 200,
+                                    len(entries), len(new))
+        return new
+
+    def poll(self):
+        """Fetch every monitor once and pass new entries to the consumers.
+
+        :returns: List of the new entries.
+        """
+        collected = list()
+        for monitor in self.monitors:
+            try:
+                entries = self.poll_monitor(monitor)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(monitor, e)
+                else:
+                    self._log.error("Failed to poll %s: %s"
+                                    % (monitor['monitor_id'], e))
+                continue
+            if not entries:
+                continue
+            for consumer in self.consumers:
+                consumer(entries)
+            collected.extend(entries)
+        return collected
+
+    def run(self, interval=300, iterations=None):
+        """Poll every `interval` seconds, forever or `iterations` times."""
+        count = 0
+        while iterations is None or count < iterations:
+            started = time.time()
+            self.poll()
+            count += 1
+            if iterations is None or count < iterations:
+                time.sleep(max(0, interval - (time.time() - started)))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""Collect alert results from Google Alerts emails in mbox or Maildir."""
+import email
+import email.header
+import email.utils
+import os
+import re
+import time
+
+from google_alerts.feeds import clean_text, entry_id, unwrap_url
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+__author__ = "Brandon Dixon"
+__copyright__ = "Copyright, Brandon Dixon"
+__credits__ = ["Brandon Dixon"]
+__license__ = "MIT"
+__maintainer__ = "Brandon Dixon"
+__email__ = "brandon@9bplus.com"
+__status__ = "BETA"
+
+
+SENDER = 'googlealerts-noreply@google.com'
+SUBJECT = re.compile(r'^Google Alert - (.+)$', re.IGNORECASE)
+DIGEST = re.compile(r'^(Daily|Weekly) Digest$', re.IGNORECASE)
+FROM_LINE = re.compile(br'^>+From ')
+WORDS = re.compile(r'\w+', re.UNICODE)
+RESULT_LINK = re.compile(r'<a\s[^>]*?href="(https?://www\.google\.com/url\?'
+                         r'[^"]*?ct=ga[^"]*)"[^>]*>(.*?)</a>',
+                         re.IGNORECASE | re.DOTALL)
+DESCRIPTION = re.compile(r'<(?:div|span|td)[^>]*itemprop="description"[^>]*>'
+                         r'(.*?)</(?:div|span|td)>',
+                         re.IGNORECASE | re.DOTALL)
+
+
+def iter_mbox(path, chunk_size=1 << 20):
+    """Yield the raw bytes of each message of an mbox file.
+
+    The file is read line by line so only one message is held in memory at
+    a time, whatever the size of the mailbox. Quoted `>From ` lines are
+    unescaped.
+    """
+    lines = list()
+    previous_blank = True
+    with open(path, 'rb', chunk_size) as f:
+        for line in f:
+            if previous_blank and line.startswith(b'From '):
+                if lines:
+                    yield b''.join(lines)
+                lines = list()
+                previous_blank = False
+                continue
+            previous_blank = line in (b'\n', b'\r\n')
+            if FROM_LINE.match(line):
+                line = line[1:]
+            lines.append(line)
+    if lines:
+        yield b''.join(lines)
+
+
+def iter_maildir(path):
+    """Yield the raw bytes of each message of a Maildir, oldest first."""
+    names = list()
+    for sub in ('cur', 'new'):
+        directory = os.path.join(path, sub)
+        if not os.path.isdir(directory):
+            continue
+        names.extend(os.path.join(directory, x) for x in os.listdir(directory)
+                     if not x.startswith('.'))
+    for name in sorted(names, key=lambda x: os.path.basename(x)):
+        with open(name, 'rb') as f:
+            yield f.read()
+
+
+def iter_messages(path):
+    """Yield raw messages from an mbox file or a Maildir directory."""
+    if os.path.isdir(path):
+        return iter_maildir(path)
+    return iter_mbox(path)
+
+
+def header(message, name):
+    """Decode a header to text."""
+    value = message.get(name)
+    if value is None:
+        return ''
+    return str(email.header.make_header(email.header.decode_header(value)))
+
+
+def html_body(message):
+    """Return the HTML part of a message as text, if there is one."""
+    for part in message.walk():
+        if part.get_content_type() != 'text/html':
+            continue
+        payload = part.get_payload(decode=True) or b''
+        charset = part.get_content_charset() or 'utf-8'
+        try:
+            return payload.decode(charset, 'replace')
+        except LookupError:
+            return payload.decode('utf-8', 'replace')
+    return None
+
+
+def parse_results(html):
+    """Return title, snippet and URL of every result in an alert email.
+
+    Results are the links through `google.com/url` tagged with `ct=ga`. The
+    link text is the title and the first element marked
+    `itemprop="description"` before the next result is the snippet. Regular
+    expressions are used rather than a full HTML parser since they are an
+    order of magnitude faster on these messages.
+    """
+    links = [(x.start(), x.end(), x.group(1), x.group(2))
+             for x in RESULT_LINK.finditer(html)]
+    descriptions = [(x.start(), x.group(1))
+                    for x in DESCRIPTION.finditer(html)]
+    seen = set()
+    results = list()
+    position = 0
+    for i, (start, end, href, title) in enumerate(links):
+        following = links[i + 1][0] if i + 1 < len(links) else len(html)
+        snippet = ''
+        while position < len(descriptions) and \
+                descriptions[position][0] < following:
+            if descriptions[position][0] >= end and not snippet:
+                snippet = descriptions[position][1]
+            position += 1
+        title = clean_text(title)
+        url = unwrap_url(unescape(href))
+        if not title or url in seen:
+            continue
+        seen.add(url)
+        results.append({'title': title, 'snippet': clean_text(snippet),
+                        'url': url})
+    return results
+
+
+def term_words(term):
+    """Words a result must contain to match a monitor term."""
+    words = WORDS.findall(term.lower())
+    return set(x for x in words if x not in ('or', 'and'))
+
+
+class MailReader(object):
+    """Turn Google Alerts emails into entries mapped to their monitors.
+
+    Monitors come from `GoogleAlerts.list`; only `MAIL` monitors are used.
+    Single term alerts are matched through the term in the subject and the
+    recipient address. Digests group several terms in one email, so each of
+    their results goes to the monitor of that recipient whose term words
+    all appear in the result, preferring the most specific term. Results
+    that can't be mapped keep a `monitor_id` of None.
+
+    Entries have the same keys as the ones built from RSS feeds.
+
+    With `stats`, every complete `read` of a mailbox is recorded in a
+    `Stats` instance as one fetch per mail monitor, including monitors
+    without any message. Results published after the previous read of a
+    monitor count as new, so reading the same mailbox again does not.
+    """
+
+    def __init__(self, monitors, stats=None):
+        self.stats = stats
+        self._monitors = list()
+        self._by_term = dict()
+        self._by_address = dict()
+        for monitor in monitors:
+            if monitor.get('delivery') != 'MAIL':
+                continue
+            self._monitors.append(monitor)
+            address = (monitor.get('email_address') or '').lower()
+            self._by_term[(address, monitor['term'].lower())] = monitor
+            self._by_address.setdefault(address, []).append(
+                (term_words(monitor['term']), monitor))
+        for candidates in self._by_address.values():
+            candidates.sort(key=lambda x: len(x[0]), reverse=True)
+
+    def _match(self, address, term, result):
+        monitor = self._by_term.get((address, (term or '').lower()))
+        if monitor:
+            return monitor
+        words = set(WORDS.findall(('%s %s' % (result['title'],
+                                              result['snippet'])).lower()))
+        for needed, monitor in self._by_address.get(address, []):
+            if needed and needed <= words:
+                return monitor
+        return None
+
+    def read_message(self, raw):
+        """Return the entries of one raw message, empty if not an alert."""
+        if isinstance(raw, bytes):
+            head = raw[:raw.find(b'\n\n')].lower()
+            if SENDER.encode() not in head and b'google alert' not in head:
+                return list()
+        message = email.message_from_bytes(raw) \
+            if isinstance(raw, bytes) else email.message_from_string(raw)
+        sender = email.utils.parseaddr(header(message, 'From'))[1].lower()
+        subject = SUBJECT.match(' '.join(header(message, 'Subject').split()))
+        if sender != SENDER and not subject:
+            return list()
+        html = html_body(message)
+        if not html:
+            return list()
+        term = subject.group(1) if subject else None
+        if term and DIGEST.match(term):
+            term = None
+        address = email.utils.parseaddr(header(message, 'To'))[1].lower()
+        published = None
+        date = email.utils.parsedate_tz(header(message, 'Date'))
+        if date:
+            published = email.utils.mktime_tz(date)
+        entries = list()
+        for result in parse_results(html):
+            monitor = self._match(address, term, result) or \
+                {'monitor_id': None, 'term': term}
+            entries.append({
+                'id': entry_id(monitor['monitor_id'], result['url']),
+                'monitor_id': monitor['monitor_id'],
+                'term': monitor['term'],
+                'title': result['title'],
+                'snippet': result['snippet'],
+                'url': result['url'],
+                'published': published
+            })
+        return entries
+
+    def read(self, path):
+        """Yield the entries of every alert in an mbox file or Maildir.
+
+        Stats are recorded once every message was read.
+        """
+        started = time.time()
+        counts = dict((x['monitor_id'], [0, 0]) for x in self._monitors)
+        last = dict()
+        if self.stats:
+            for monitor in self._monitors:
+                last[monitor['monitor_id']] = self.stats.monitor(
+                    monitor['monitor_id'], monitor['term']).last_fetch
+        for raw in iter_messages(path):
+            for entry in self.read_message(raw):
+                count = counts.get(entry['monitor_id'])
+                if count:
+                    count[0] += 1
+                    previous = last.get(entry['monitor_id'])
+                    if previous is None or \
+                            (entry['published'] or started) > previous:
+                        count[1] += 1
+                yield entry
+        if not self.stats:
+            return
+        latency = time.time() - started
+        for monitor in self._monitors:
+            entries, new = counts[monitor['monitor_id']]
+            self.stats.record_fetch(monitor, latency, 200, entries, new,
+                                    started)
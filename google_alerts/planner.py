@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""Pack compatible terms into fewer monitors using OR queries."""
+import json
+import os
+import re
+
+from google_alerts import (ActionError, CONFIG_PATH, InvalidConfig,
+                           _atomic_write)
+from google_alerts.feeds import entry_id
+
+__author__ = "Brandon Dixon"
+__copyright__ = "Copyright, Brandon Dixon"
+__credits__ = ["Brandon Dixon"]
+__license__ = "MIT"
+__maintainer__ = "Brandon Dixon"
+__email__ = "brandon@9bplus.com"
+__status__ = "BETA"
+
+
+PLAN_FILE = os.path.join(CONFIG_PATH, 'plan.json')
+WORDS = re.compile(r'\w+', re.UNICODE)
+PHRASES = re.compile(r'"([^"]*)"')
+OPERATORS = re.compile(r'(^|\s)-\S|\w:\S|\bOR\b|[()|*]')
+JOINERS = re.compile(r"(?<=\w)[-'.](?=\w)", re.UNICODE)
+SYMBOLS = re.compile(r'[^\w\s"]', re.UNICODE)
+SEPARATOR = ' OR '
+GROUP_KEYS = ('delivery', 'alert_frequency', 'monitor_match', 'language',
+              'region')
+
+
+def group_key(options):
+    """Settings that must be shared by terms packed into one monitor.
+
+    Defaults are the ones `GoogleAlerts.create` applies. RSS monitors have no
+    frequency so it is left out of their key.
+    """
+    if 'delivery' not in options:
+        raise InvalidConfig("`delivery` is required in options.")
+    key = {'delivery': options['delivery'].upper(),
+           'alert_frequency': options.get('alert_frequency',
+                                          'AT_MOST_ONCE_A_DAY'),
+           'monitor_match': options.get('monitor_match', 'ALL'),
+           'language': options.get('language', 'en'),
+           'region': options.get('region', 'US')}
+    if key['delivery'] == 'RSS':
+        key['alert_frequency'] = None
+    return tuple(key[x] for x in GROUP_KEYS)
+
+
+def monitor_key(monitor):
+    """`group_key` of a monitor as returned by `GoogleAlerts.list`."""
+    options = {'delivery': monitor['delivery'],
+               'monitor_match': monitor['match_type'],
+               'language': monitor['language'],
+               'region': monitor['region']}
+    if monitor.get('alert_frequency'):
+        options['alert_frequency'] = monitor['alert_frequency']
+    return group_key(options)
+
+
+def query_part(term):
+    """Render a term so it keeps its meaning inside an OR query.
+
+    A term made of a single phrase is left as is, anything else with more
+    than one word is grouped in parentheses.
+    """
+    if PHRASES.fullmatch(term):
+        return term
+    if len(term.split()) > 1:
+        return '(%s)' % term
+    return term
+
+
+def packable(term):
+    """Whether a term can share a query with others.
+
+    Terms using search operators (exclusions, `site:` and the like, their own
+    ORs or grouping) keep a monitor of their own since their meaning would
+    change once combined. So do terms with symbols other than hyphens,
+    apostrophes and dots inside words, such as `C++` or `AT&T`, since
+    `term_matcher` only sees their words and could not tell their results
+    apart.
+    """
+    if OPERATORS.search(PHRASES.sub('', term)):
+        return False
+    return not SYMBOLS.search(JOINERS.sub('', term))
+
+
+def term_matcher(term):
+    """Return a function telling if a text is a result of `term`.
+
+    Quoted parts must appear as phrases and every other word must appear
+    somewhere in the text, case insensitively.
+    """
+    phrases = [' %s ' % ' '.join(WORDS.findall(x.lower()))
+               for x in PHRASES.findall(term)]
+    words = set(WORDS.findall(PHRASES.sub(' ', term).lower()))
+    phrases = [x for x in phrases if x.strip()]
+
+    def match(text):
+        tokens = WORDS.findall(text.lower())
+        if not words <= set(tokens):
+            return False
+        text = ' %s ' % ' '.join(tokens)
+        return all(x in text for x in phrases)
+    return match
+
+
+class QueryPlanner(object):
+    """Bin-pack terms into monitors.
+
+    Terms are grouped by delivery, frequency, match type, language and
+    region. Within a group, terms are packed first-fit by decreasing volume
+    into OR queries of at most `max_length` characters and `max_words`
+    words, whose summed expected volume (new results a day) stays under
+    `max_volume`. A term above `max_volume` or using search operators gets
+    a monitor of its own.
+
+    Terms are given as strings or dicts with a `term`, its `options` (as for
+    `GoogleAlerts.create`) and an optional expected `volume`. Exact terms
+    are kept in quotes, as `create` would store them. Volumes that are not
+    given come from a `Stats` instance when one is passed, else
+    `default_volume` is assumed.
+    """
+
+    def __init__(self, max_length=256, max_words=32, max_volume=20.0,
+                 default_volume=1.0):
+        self.max_length = max_length
+        self.max_words = max_words
+        self.max_volume = max_volume
+        self.default_volume = default_volume
+
+    def _normalize(self, terms, options, stats):
+        volumes = dict()
+        if stats:
+            for item in stats.summary():
+                volumes[item['term']] = item['new_per_day']
+        normalized = list()
+        for item in terms:
+            if not isinstance(item, dict):
+                item = {'term': item}
+            item_options = dict(options or {})
+            item_options.update(item.get('options') or {})
+            term = ' '.join(item['term'].split())
+            if item_options.pop('exact', False):
+                term = '"%s"' % term.strip('"')
+            volume = item.get('volume')
+            if volume is None:
+                volume = volumes.get(term, self.default_volume)
+            normalized.append({
+                'term': term,
+                'part': query_part(term),
+                'options': item_options,
+                'volume': volume
+            })
+        return normalized
+
+    def _fits(self, packed, item):
+        query = packed['query'] + SEPARATOR + item['part']
+        return len(query) <= self.max_length and \
+            len(query.split()) <= self.max_words and \
+            packed['volume'] + item['volume'] <= self.max_volume
+
+    def plan(self, terms, options=None, stats=None):
+        """Pack terms into monitors.
+
+        :param options: Defaults for the options of every term.
+        :returns: List of monitors to create, each a dict with the `query`,
+            its `options`, the original `terms` and the expected `volume`.
+        """
+        groups = dict()
+        for item in self._normalize(terms, options, stats):
+            key = group_key(item['options'])
+            groups.setdefault(key, dict())[item['term']] = item
+        plan = list()
+        for key in sorted(groups, key=lambda x: [str(y) for y in x]):
+            items = sorted(groups[key].values(),
+                           key=lambda x: (-x['volume'], x['term']))
+            bins = list()
+            for item in items:
+                single = not packable(item['term']) or \
+                    item['volume'] >= self.max_volume
+                target = None
+                if not single:
+                    target = next((x for x in bins if x['packable'] and
+                                   self._fits(x, item)), None)
+                if target is None:
+                    options = dict(zip(GROUP_KEYS, key))
+                    if options['alert_frequency'] is None:
+                        del options['alert_frequency']
+                    bins.append({'query': item['part'], 'options': options,
+                                 'terms': [item['term']],
+                                 'volume': item['volume'],
+                                 'packable': not single})
+                    continue
+                target['query'] += SEPARATOR + item['part']
+                target['terms'].append(item['term'])
+                target['volume'] += item['volume']
+            for packed in bins:
+                del packed['packable']
+                if len(packed['terms']) == 1:
+                    packed['query'] = packed['terms'][0]
+                plan.append(packed)
+        return plan
+
+
+class TermMap(object):
+    """Mapping of packed monitors to the terms they stand for.
+
+    `fan_out` turns the entries of a packed monitor into one entry per
+    original term found in the result, with that term in `term` and the
+    packed query in `query`. Results matching none of the terms, for example
+    through synonyms, are passed on unchanged. Entries of monitors that are
+    not in the map are passed on as they are.
+    """
+
+    def __init__(self, monitors=None):
+        self._monitors = dict()
+        self._matchers = dict()
+        for item in monitors or []:
+            self.add(item)
+
+    def add(self, monitor):
+        """Add a packed monitor with its `monitor_id`, `query` and `terms`."""
+        self._monitors[monitor['monitor_id']] = monitor
+        self._matchers[monitor['monitor_id']] = \
+            [(x, term_matcher(x)) for x in monitor['terms']]
+
+    def remove(self, monitor_id):
+        self._monitors.pop(monitor_id, None)
+        self._matchers.pop(monitor_id, None)
+
+    def monitors(self):
+        return list(self._monitors.values())
+
+    def get(self, monitor_id):
+        return self._monitors.get(monitor_id)
+
+    def fan_out(self, entries):
+        """Split the entries of packed monitors into per-term entries."""
+        fanned = list()
+        for entry in entries:
+            matchers = self._matchers.get(entry['monitor_id'])
+            if not matchers:
+                fanned.append(entry)
+                continue
+            text = '%s %s' % (entry.get('title') or '',
+                              entry.get('snippet') or '')
+            terms = [term for term, match in matchers if match(text)]
+            if not terms:
+                fanned.append(entry)
+                continue
+            for term in terms:
+                item = dict(entry)
+                item['id'] = entry_id('%s|%s' % (entry['monitor_id'], term),
+                                      entry['url'])
+                item['term'] = term
+                item['query'] = entry['term']
+                fanned.append(item)
+        return fanned
+
+    def consumer(self, consumers):
+        """Wrap consumers so they receive fanned out entries.
+
+        The result can be given to `FeedPoller` in place of the consumers.
+        """
+        def consume(entries):
+            entries = self.fan_out(entries)
+            for consumer in consumers:
+                consumer(entries)
+        return consume
+
+    def save(self, path=PLAN_FILE):
+        """Atomically write the map to a JSON file."""
+        data = {'version': 1, 'monitors': self.monitors()}
+        _atomic_write(path, json.dumps(data, indent=4))
+
+    @classmethod
+    def load(cls, path=PLAN_FILE):
+        """Read a map from a JSON file, empty if it does not exist."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data.get('monitors', []))
+
+
+def apply_plan(ga, plan, term_map=None, replace=True):
+    """Create the monitors of a plan and remove the ones it supersedes.
+
+    Monitors already matching a planned query and its settings are kept.
+    New ones are created before anything is deleted so no term goes
+    unwatched. Packed monitors of the map that are no longer planned are
+    deleted and, with `replace`, so are existing single-term monitors whose
+    term is now covered by a packed monitor with the same settings.
+
+    :param ga: Authenticated `GoogleAlerts` client.
+    :param term_map: `TermMap` updated in place, a new one by default.
+    :returns: Tuple of the `TermMap` and a list of the actions taken.
+    """
+    term_map = term_map if term_map is not None else TermMap()
+    monitors = ga.list()
+    existing = dict()
+    known = set(x['monitor_id'] for x in monitors)
+    for monitor in monitors:
+        existing.setdefault((monitor['term'], monitor_key(monitor)),
+                            monitor['monitor_id'])
+
+    actions = list()
+    keep = set()
+    covered = set()
+    for item in plan:
+        key = group_key(item['options'])
+        monitor_id = existing.get((item['query'], key))
+        if monitor_id is None:
+            created = [x for x in ga.create(item['query'], item['options'])
+                       if x['monitor_id'] not in known and
+                       monitor_key(x) == key]
+            if not created:
+                raise ActionError("Created monitor for %s was not found."
+                                  % item['query'])
+            monitor_id = created[0]['monitor_id']
+            known.add(monitor_id)
+            actions.append({'action': 'create', 'monitor_id': monitor_id,
+                            'query': item['query'], 'terms': item['terms']})
+        keep.add(monitor_id)
+        if len(item['terms']) > 1:
+            term_map.add({'monitor_id': monitor_id, 'query': item['query'],
+                          'terms': list(item['terms']),
+                          'options': dict(item['options'])})
+            covered.update((x, key) for x in item['terms'])
+        else:
+            term_map.remove(monitor_id)
+
+    stale = set(x['monitor_id'] for x in term_map.monitors()) - keep
+    if replace:
+        for (term, key), monitor_id in existing.items():
+            if (term, key) in covered and monitor_id not in keep:
+                stale.add(monitor_id)
+    for monitor_id in sorted(stale):
+        ga.delete(monitor_id)
+        term_map.remove(monitor_id)
+        actions.append({'action': 'delete', 'monitor_id': monitor_id})
+    return term_map, actions
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Full-text search over collected alert results."""
+import sqlite3
+
+from google_alerts import InvalidConfig, InvalidQuery
+
+__author__ = "Brandon Dixon"
+__copyright__ = "Copyright, Brandon Dixon"
+__credits__ = ["Brandon Dixon"]
+__license__ = "MIT"
+__maintainer__ = "Brandon Dixon"
+__email__ = "brandon@9bplus.com"
+__status__ = "BETA"
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    entry_id TEXT NOT NULL UNIQUE,
+    monitor_id TEXT,
+    term TEXT,
+    url TEXT,
+    published INTEGER,
+    title TEXT,
+    snippet TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_published ON entries (published);
+CREATE INDEX IF NOT EXISTS entries_monitor
+    ON entries (monitor_id, published);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    title, snippet, content='entries', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts (rowid, title, snippet)
+    VALUES (new.id, new.title, new.snippet);
+END;
+"""
+FIELDS = ('entry_id', 'monitor_id', 'term', 'url', 'published', 'title',
+          'snippet')
+
+
+class SearchIndex(object):
+    """Local full-text index of alert entries backed by SQLite FTS5.
+
+    Entries are added incrementally, for instance as a `FeedPoller` consumer,
+    and entries already in the index are skipped. Queries use the FTS5
+    syntax, so phrases (`"data breach"`), boolean operators (`acme OR
+    widgets`, `acme NOT hiring`) and prefixes (`ransom*`) all work, and can
+    be narrowed down by monitor, term and a published time range.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        try:
+            self._db.executescript(SCHEMA)
+        except sqlite3.OperationalError as e:
+            raise InvalidConfig("SQLite lacks FTS5 support: %s" % e)
+
+    def add(self, entries):
+        """Index a batch of entries in one transaction.
+
+        :returns: Number of entries that were not indexed before.
+        """
+        rows = [(x['id'], x.get('monitor_id'), x.get('term'), x.get('url'),
+                 x.get('published'), x.get('title', ''), x.get('snippet', ''))
+                for x in entries]
+        with self._db:
+            cursor = self._db.executemany(
+                'INSERT OR IGNORE INTO entries (%s) VALUES (?, ?, ?, ?, ?, ?, ?)'
+                % ', '.join(FIELDS), rows)
+            return cursor.rowcount
+
+    __call__ = add
+
+    def _filters(self, monitor_id, term, since, until):
+        clauses, params = list(), list()
+        if monitor_id:
+            clauses.append('e.monitor_id = ?')
+            params.append(monitor_id)
+        if term:
+            clauses.append('e.term = ?')
+            params.append(term)
+        if since is not None:
+            clauses.append('e.published >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('e.published < ?')
+            params.append(until)
+        return clauses, params
+
+    def search(self, query, monitor_id=None, term=None, since=None,
+               until=None, limit=20, offset=0, order='rank'):
+        """Search indexed entries.
+
+        :param query: FTS5 query over titles and snippets.
+        :param since: Only entries published at or after this epoch time.
+        :param until: Only entries published before this epoch time.
+        :param order: `rank` for best match first or `recent` for newest.
+        :returns: List of entry dicts for the requested page.
+        """
+        clauses, params = self._filters(monitor_id, term, since, until)
+        clauses.insert(0, 'entries_fts MATCH ?')
+        params.insert(0, query)
+        sort = 'e.published DESC' if order == 'recent' else 'entries_fts.rank'
+        sql = ('SELECT e.* FROM entries_fts JOIN entries e '
+               'ON e.id = entries_fts.rowid WHERE %s ORDER BY %s '
+               'LIMIT ? OFFSET ?' % (' AND '.join(clauses), sort))
+        try:
+            rows = self._db.execute(sql, params + [limit, offset]).fetchall()
+        except sqlite3.OperationalError as e:
+            raise InvalidQuery("Unable to run query %r: %s" % (query, e))
+        return [self._entry(x) for x in rows]
+
+    def count(self, query=None, monitor_id=None, term=None, since=None,
+              until=None):
+        """Count entries matching a query and filters."""
+        clauses, params = self._filters(monitor_id, term, since, until)
+        sql = 'SELECT COUNT(*) FROM entries e'
+        if query:
+            sql += ' JOIN entries_fts ON e.id = entries_fts.rowid'
+            clauses.insert(0, 'entries_fts MATCH ?')
+            params.insert(0, query)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        try:
+            return self._db.execute(sql, params).fetchone()[0]
+        except sqlite3.OperationalError as e:
+            raise InvalidQuery("Unable to run query %r: %s" % (query, e))
+
+    def _entry(self, row):
+        entry = dict(zip(row.keys(), tuple(row)))
+        entry['id'] = entry.pop('entry_id')
+        return entry
+
+    def optimize(self):
+        """Merge the FTS segments after a large ingestion."""
+        with self._db:
+            self._db.execute(
+                "INSERT INTO entries_fts (entries_fts) VALUES ('optimize')")
+
+    def close(self):
+        self._db.close()
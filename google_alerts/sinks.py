@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""Deliver collected alert results to files, sockets and collectors."""
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import requests
+
+from google_alerts import GoogleAlerts
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+__author__ = "Brandon Dixon"
+__copyright__ = "Copyright, Brandon Dixon"
+__credits__ = ["Brandon Dixon"]
+__license__ = "MIT"
+__maintainer__ = "Brandon Dixon"
+__email__ = "brandon@9bplus.com"
+__status__ = "BETA"
+
+
+_FLUSH = object()
+_STOP = object()
+
+
+def encode(entries):
+    """Serialize entries as JSON lines."""
+    return ''.join(json.dumps(x, sort_keys=True) + '\n' for x in entries)
+
+
+class Sink(object):
+    """Base class for batching sinks.
+
+    Entries submitted to a sink go into a bounded queue drained by a
+    background thread, which hands them to `write` in batches of up to
+    `batch_size` entries, or whatever arrived within `flush_interval`
+    seconds. When the queue is full `submit` blocks, so a slow destination
+    slows the poller down instead of buffering without limit.
+
+    A failed batch is retried `retries` times with exponential backoff. If it
+    still fails, its entries are appended to the `dead_letter` file along
+    with the error, or logged and dropped when there is none.
+
+    Subclasses implement `write(batch)` and optionally `close_sink()`.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1.0, queue_size=10000,
+                 retries=3, backoff=0.5, dead_letter=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.dead_letter = dead_letter
+        self.delivered = 0
+        self.failed = 0
+        self.batches = 0
+        self._log = logging.getLogger(GoogleAlerts.NAME)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run,
+                                        name=self.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check_alive(self):
+        if not self._thread.is_alive():
+            raise RuntimeError("%s is closed or its delivery thread died."
+                               % self.__class__.__name__)
+
+    def submit(self, entries):
+        """Queue entries for delivery, blocking while the queue is full.
+
+        :raises RuntimeError: When the sink no longer delivers.
+        """
+        for entry in entries:
+            while True:
+                self._check_alive()
+                try:
+                    self._queue.put(entry, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    __call__ = submit
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def close_sink(self):
+        pass
+
+    def _run(self):
+        batch = list()
+        deadline = None
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(0, deadline - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                batch = self._complete(batch)
+                continue
+            if item is _FLUSH or item is _STOP:
+                batch = self._complete(batch)
+                self._queue.task_done()
+                if item is _STOP:
+                    return
+                continue
+            if not batch:
+                deadline = time.time() + self.flush_interval
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                batch = self._complete(batch)
+
+    def _complete(self, batch):
+        try:
+            self._deliver(batch)
+        except Exception as e:
+            self._log.error("%s dropped %d entries: %s"
+                            % (self.__class__.__name__, len(batch), e))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+        return list()
+
+    def _deliver(self, batch):
+        if not batch:
+            return
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                self.write(batch)
+                self.delivered += len(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+        self.failed += len(batch)
+        self._log.error("%s failed to deliver %d entries: %s"
+                        % (self.__class__.__name__, len(batch), error))
+        if not self.dead_letter:
+            return
+        error = "%s: %s" % (error.__class__.__name__, error)
+        try:
+            with open(self.dead_letter, 'a') as f:
+                f.write(encode([{'sink': self.__class__.__name__,
+                                 'error': error, 'entry': x} for x in batch]))
+        except Exception as e:
+            self._log.error("Failed to write to the dead letter file %s: %s"
+                            % (self.dead_letter, e))
+
+    def flush(self):
+        """Block until every submitted entry was delivered or dead-lettered.
+
+        :raises RuntimeError: When the sink no longer delivers.
+        """
+        self.submit([_FLUSH])
+        while self._queue.unfinished_tasks:
+            self._check_alive()
+            with self._queue.all_tasks_done:
+                if self._queue.unfinished_tasks:
+                    self._queue.all_tasks_done.wait(1)
+
+    def close(self):
+        """Deliver what is left and stop the background thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self.close_sink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StdoutSink(Sink):
+    """Write entries as JSON lines to a stream, stdout by default."""
+
+    def __init__(self, stream=None, **kwargs):
+        self.stream = stream or sys.stdout
+        Sink.__init__(self, **kwargs)
+
+    def write(self, batch):
+        self.stream.write(encode(batch))
+        self.stream.flush()
+
+
+class JsonlSink(Sink):
+    """Append entries as JSON lines to a file with size based rotation.
+
+    Once the file reaches `max_bytes` it is renamed to `path.1`, older files
+    shift up by one and only `backups` of them are kept.
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backups=5,
+                 **kwargs):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = None
+        Sink.__init__(self, **kwargs)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def write(self, batch):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(encode(batch))
+        self._file.flush()
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def close_sink(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class UnixSocketSink(Sink):
+    """Stream entries as JSON lines to a Unix domain socket.
+
+    The connection is opened on the first batch and again after a failure.
+    """
+
+    def __init__(self, path, timeout=10, **kwargs):
+        self.path = path
+        self.timeout = timeout
+        self._socket = None
+        Sink.__init__(self, **kwargs)
+
+    def write(self, batch):
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._socket = sock
+        try:
+            self._socket.sendall(encode(batch).encode('utf-8'))
+        except Exception:
+            self.close_sink()
+            raise
+
+    def close_sink(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+
+class HttpSink(Sink):
+    """POST batches of entries as a JSON array to a collector."""
+
+    def __init__(self, url, timeout=10, headers=None, **kwargs):
+        self.url = url
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/json'}
+        self.headers.update(headers or {})
+        self._session = requests.session()
+        Sink.__init__(self, **kwargs)
+
+    def write(self, batch):
+        response = self._session.post(self.url, data=json.dumps(batch),
+                                      headers=self.headers,
+                                      timeout=self.timeout)
+        response.raise_for_status()
+
+    def close_sink(self):
+        self._session.close()
+
+
+def sink_from_spec(spec, **kwargs):
+    """Build a sink from a short description.
+
+    `-` or `stdout` for standard output, `unix:<path>` for a socket,
+    `http://` or `https://` URLs for a collector and anything else, with or
+    without a `jsonl:` prefix, for a file.
+    """
+    if spec in ('-', 'stdout'):
+        return StdoutSink(**kwargs)
+    if spec.startswith('unix:'):
+        return UnixSocketSink(spec[5:], **kwargs)
+    if spec.startswith(('http://', 'https://')):
+        return HttpSink(spec, **kwargs)
+    if spec.startswith('jsonl:'):
+        spec = spec[6:]
+    return JsonlSink(spec, **kwargs)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""Volume statistics for monitors kept in compact time series."""
+import array
+import base64
+import json
+import os
+import threading
+import time
+
+from google_alerts import CONFIG_PATH, _atomic_write
+
+__author__ = "Brandon Dixon"
+__copyright__ = "Copyright, Brandon Dixon"
+__credits__ = ["Brandon Dixon"]
+__license__ = "MIT"
+__maintainer__ = "Brandon Dixon"
+__email__ = "brandon@9bplus.com"
+__status__ = "BETA"
+
+
+STATS_FILE = os.path.join(CONFIG_PATH, 'stats.json')
+HOUR = 3600
+DAY = 86400
+METRICS = ('entries', 'new', 'duplicate', 'fetches', 'errors', 'latency')
+TIERS = ((HOUR, 24 * 7), (DAY, 365))
+
+
+class Series(object):
+    """Fixed-interval ring buffer of float sums.
+
+    Values are added to the slot of their timestamp. Slots that fall out of
+    the `size * interval` window are reused, so memory never grows.
+    """
+
+    def __init__(self, interval, size, values=None, last=None):
+        self.interval = interval
+        self.size = size
+        self._values = array.array('f', [0.0]) * size
+        if values is not None:
+            self._values = array.array('f', values)
+        self._last = last
+
+    def _advance(self, slot):
+        if self._last is None:
+            self._last = slot
+            return
+        if slot <= self._last:
+            return
+        for i in range(self._last + 1, min(slot, self._last + self.size) + 1):
+            self._values[i % self.size] = 0.0
+        self._last = slot
+
+    def add(self, value, timestamp=None):
+        """Add a value to the slot of `timestamp`, now by default."""
+        if timestamp is None:
+            timestamp = time.time()
+        slot = int(timestamp // self.interval)
+        self._advance(slot)
+        if self._last - slot >= self.size:
+            return
+        self._values[slot % self.size] += value
+
+    def points(self, since=None, until=None):
+        """Return (slot start, value) pairs, oldest first."""
+        if self._last is None:
+            return list()
+        if until is None:
+            until = time.time()
+        now = int(until // self.interval)
+        first = max(now - self.size + 1, self._last - self.size + 1)
+        if since is not None:
+            first = max(first, int(since // self.interval))
+        return [(i * self.interval,
+                 self._values[i % self.size] if i <= self._last else 0.0)
+                for i in range(first, now + 1)]
+
+    def total(self, since=None, until=None):
+        """Sum of the values between two timestamps."""
+        return sum(x[1] for x in self.points(since, until))
+
+    def downsample(self, factor, since=None, until=None):
+        """Return points merged into buckets of `factor` slots."""
+        merged = list()
+        for start, value in self.points(since, until):
+            bucket = start - start % (self.interval * factor)
+            if merged and merged[-1][0] == bucket:
+                merged[-1][1] += value
+            else:
+                merged.append([bucket, value])
+        return [tuple(x) for x in merged]
+
+    def dump(self):
+        return {'interval': self.interval, 'size': self.size,
+                'last': self._last,
+                'values': base64.b64encode(self._values.tobytes()).decode()}
+
+    @classmethod
+    def restore(cls, data):
+        values = array.array('f')
+        values.frombytes(base64.b64decode(data['values']))
+        return cls(data['interval'], data['size'], values, data['last'])
+
+
+class MonitorStats(object):
+    """Counters of a single monitor in hourly and daily tiers.
+
+    The hourly tier covers a week and the daily tier a year, for every
+    metric in `METRICS`. `latency` holds the sum of fetch times in seconds.
+    """
+
+    def __init__(self, monitor_id, term=None):
+        self.monitor_id = monitor_id
+        self.term = term
+        self.first_fetch = None
+        self.last_status = None
+        self.last_fetch = None
+        self.last_new = None
+        self.series = dict((m, [Series(i, s) for i, s in TIERS])
+                           for m in METRICS)
+
+    def add(self, metric, value, timestamp=None):
+        for series in self.series[metric]:
+            series.add(value, timestamp)
+
+    def total(self, metric, window=7 * DAY, now=None):
+        """Sum of a metric over the last `window` seconds."""
+        now = now or time.time()
+        tier = self.series[metric][0 if window <= 7 * DAY else 1]
+        return tier.total(now - window, now)
+
+    def summary(self, window=7 * DAY, now=None):
+        """Totals of every metric over the window with derived rates."""
+        totals = dict((m, self.total(m, window, now)) for m in METRICS)
+        fetches = totals['fetches']
+        summary = {
+            'monitor_id': self.monitor_id,
+            'term': self.term,
+            'entries': int(totals['entries']),
+            'new': int(totals['new']),
+            'duplicate': int(totals['duplicate']),
+            'fetches': int(fetches),
+            'errors': int(totals['errors']),
+            'new_per_day': totals['new'] / (window / float(DAY)),
+            'avg_latency': totals['latency'] / fetches if fetches else None,
+            'error_rate': totals['errors'] / fetches if fetches else None,
+            'first_fetch': self.first_fetch,
+            'last_status': self.last_status,
+            'last_fetch': self.last_fetch,
+            'last_new': self.last_new
+        }
+        return summary
+
+    def dump(self):
+        return {'monitor_id': self.monitor_id, 'term': self.term,
+                'first_fetch': self.first_fetch,
+                'last_status': self.last_status,
+                'last_fetch': self.last_fetch, 'last_new': self.last_new,
+                'series': dict((m, [x.dump() for x in s])
+                               for m, s in self.series.items())}
+
+    @classmethod
+    def restore(cls, data):
+        stats = cls(data['monitor_id'], data.get('term'))
+        stats.first_fetch = data.get('first_fetch')
+        stats.last_status = data.get('last_status')
+        stats.last_fetch = data.get('last_fetch')
+        stats.last_new = data.get('last_new')
+        for metric, tiers in data['series'].items():
+            stats.series[metric] = [Series.restore(x) for x in tiers]
+        return stats
+
+
+class Stats(object):
+    """Per-monitor volume statistics.
+
+    Pass an instance to `FeedPoller` or `MailReader` and every fetch, or
+    read of a mailbox, is recorded. Stats can be saved to and loaded from a
+    JSON file, which is what the `google-alerts stats` command reads.
+    """
+
+    SILENT_DAYS = 7
+    NOISY_PER_DAY = 50
+    ERROR_RATE = 0.5
+
+    def __init__(self):
+        self._monitors = dict()
+        self._lock = threading.Lock()
+
+    def monitor(self, monitor_id, term=None):
+        """Return the stats of a monitor, creating them when needed."""
+        with self._lock:
+            stats = self._monitors.get(monitor_id)
+            if stats is None:
+                stats = self._monitors[monitor_id] = MonitorStats(monitor_id,
+                                                                  term)
+            if term:
+                stats.term = term
+            return stats
+
+    def record_fetch(self, monitor, latency, status, entries=0, new=0,
+                     timestamp=None):
+        """Record one feed fetch of a monitor.
+
+        :param status: HTTP status code or the name of the exception raised.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        stats = self.monitor(monitor['monitor_id'], monitor.get('term'))
+        with self._lock:
+            stats.add('fetches', 1, timestamp)
+            stats.add('latency', latency, timestamp)
+            stats.add('entries', entries, timestamp)
+            stats.add('new', new, timestamp)
+            stats.add('duplicate', entries - new, timestamp)
+            if status != 200:
+                stats.add('errors', 1, timestamp)
+            stats.first_fetch = min(stats.first_fetch or timestamp, timestamp)
+            if timestamp >= (stats.last_fetch or timestamp):
+                stats.last_status = status
+                stats.last_fetch = timestamp
+            if new:
+                stats.last_new = max(stats.last_new or timestamp, timestamp)
+
+    def summary(self, window=7 * DAY):
+        """Summaries of every monitor, noisiest first."""
+        with self._lock:
+            summaries = [x.summary(window) for x in self._monitors.values()]
+        return sorted(summaries, key=lambda x: x['new'], reverse=True)
+
+    def recommend(self, monitors, window=7 * DAY):
+        """Suggest setting changes from the recorded volume.
+
+        :param monitors: Monitors as returned by `GoogleAlerts.list`.
+        :returns: List of dicts with the `monitor_id`, a `reason` and, when
+            a change applies, the `options` to pass to `GoogleAlerts.modify`.
+            Reasons are `failing` for feeds that mostly error out, `silent`
+            for monitors without new results for a week and `noisy` for
+            monitors above `NOISY_PER_DAY` new results a day.
+        """
+        summaries = dict((x['monitor_id'], x) for x in self.summary(window))
+        now = time.time()
+        recommendations = list()
+        for monitor in monitors:
+            summary = summaries.get(monitor['monitor_id'])
+            if not summary or not summary['fetches']:
+                continue
+            item = {'monitor_id': monitor['monitor_id'],
+                    'term': monitor['term']}
+            frequency = monitor.get('alert_frequency')
+            if summary['error_rate'] >= self.ERROR_RATE:
+                item['reason'] = 'failing'
+            elif summary['new'] == 0 and \
+                    now - summary['first_fetch'] >= self.SILENT_DAYS * DAY:
+                item['reason'] = 'silent'
+                if monitor['delivery'] == 'MAIL' and \
+                        frequency != 'AT_MOST_ONCE_A_WEEK':
+                    item['options'] = {'alert_frequency':
+                                       'AT_MOST_ONCE_A_WEEK'}
+            elif summary['new_per_day'] >= self.NOISY_PER_DAY:
+                item['reason'] = 'noisy'
+                if monitor.get('match_type') == 'ALL':
+                    item['options'] = {'monitor_match': 'BEST'}
+            else:
+                continue
+            recommendations.append(item)
+        return recommendations
+
+    def save(self, path=STATS_FILE):
+        """Atomically write the stats to a JSON file."""
+        with self._lock:
+            data = {'version': 1,
+                    'monitors': [x.dump() for x in self._monitors.values()]}
+        _atomic_write(path, json.dumps(data))
+
+    @classmethod
+    def load(cls, path=STATS_FILE):
+        """Read stats from a JSON file, empty stats if it does not exist."""
+        stats = cls()
+        if not os.path.exists(path):
+            return stats
+        with open(path) as f:
+            data = json.load(f)
+        for item in data.get('monitors', []):
+            monitor = MonitorStats.restore(item)
+            stats._monitors[monitor.monitor_id] = monitor
+        return stats
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Benchmark a year of archived alerts against a JSON lines history."""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from google_alerts.archive import Archive
+
+START = 1577836800
+DAY = 86400
+
+
+def entries(days, per_day, monitors):
+    for day in range(days):
+        for i in range(per_day):
+            n = day * per_day + i
+            monitor = n % monitors
+            yield {'id': 'bench-%d' % n, 'monitor_id': 'monitor-%d' % monitor,
+                   'term': 'term %d' % monitor,
+                   'title': 'Story %d about term %d' % (n, monitor),
+                   'snippet': 'Snippet text that the archive does not keep',
+                   'url': 'https://news%d.example.com/articles/%d'
+                          % (n % 97, n),
+                   'published': START + day * DAY + i * DAY // per_day,
+                   'cluster_id': n // 3}
+
+
+def size_of(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, x))
+               for root, _, files in os.walk(path) for x in files)
+
+
+def timed(label, function):
+    began = time.time()
+    result = function()
+    print("%-34s %8.2fs %10s" % (label, time.time() - began, result))
+    return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--per-day', type=int, default=2000)
+    parser.add_argument('--monitors', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=500,
+                        help='Entries per flush, like one poll.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    history = os.path.join(workdir, 'history.jsonl')
+    archive = Archive(os.path.join(workdir, 'archive'))
+
+    def write():
+        batch = list()
+        with open(history, 'w') as f:
+            for entry in entries(args.days, args.per_day, args.monitors):
+                f.write(json.dumps(entry) + '\n')
+                batch.append(entry)
+                if len(batch) == args.batch:
+                    archive.add(batch)
+                    archive.flush()
+                    batch = list()
+        archive.add(batch)
+        archive.flush()
+        return args.days * args.per_day
+
+    timed('write jsonl + archive (rows)', write)
+    timed('compact (segments merged)', archive.compact)
+    print("%-34s %8.1f MB" % ('jsonl size', size_of(history) / 1048576.0))
+    print("%-34s %8.1f MB" % ('archive size',
+                               size_of(archive.path) / 1048576.0))
+
+    term = 'term 7'
+
+    def scan_jsonl():
+        count = 0
+        with open(history) as f:
+            for line in f:
+                count += json.loads(line)['term'] == term
+        return count
+
+    def scan_archive():
+        return sum(1 for _ in archive.scan(['url', 'published'], term=term))
+
+    def scan_month():
+        return sum(1 for _ in archive.scan(['url'], since=START + 180 * DAY,
+                                           until=START + 210 * DAY,
+                                           term=term))
+
+    timed('jsonl, one term over a year', scan_jsonl)
+    timed('archive, one term over a year', scan_archive)
+    timed('archive, one term over a month', scan_month)
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Benchmark streaming ingestion of alert emails from a large mbox."""
+import os
+import resource
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from google_alerts.mail import MailReader
+
+ADDRESS = 'alerts@example.com'
+TERMS = ['acme', 'data breach', 'ransomware', 'quantum computing', 'widgets']
+RESULT = """<tr><td itemscope itemtype="http://schema.org/Article">
+<a href="https://www.google.com/url?rct=j&amp;sa=t&amp;url=https://news.example.com/{n}/{i}&amp;ct=ga&amp;cd=CAEYACoTNjY&amp;usg=AFQjCNE" itemprop="url"><span itemprop="name">Story {n} about <b>{term}</b> number {i}</span></a>
+<div itemprop="publisher"><span itemprop="name">Example News</span></div>
+<div itemprop="description">A long snippet describing how <b>{term}</b> was in the news today,<br>with more words to fill the line {n}.</div>
+</td></tr>
+"""
+
+
+def message(n):
+    term = TERMS[n % len(TERMS)]
+    body = ''.join(RESULT.format(n=n, i=i, term=term) for i in range(8))
+    return ("From googlealerts-noreply@google.com Mon May 11 09:00:00 2020\n"
+            "From: Google Alerts <googlealerts-noreply@google.com>\n"
+            "To: %s\n"
+            "Subject: Google Alert - %s\n"
+            "Date: Mon, 11 May 2020 09:00:00 +0000\n"
+            "MIME-Version: 1.0\n"
+            "Content-Type: text/html; charset=UTF-8\n\n"
+            "<html><body><table>%s</table></body></html>\n\n"
+            % (ADDRESS, term, body))
+
+
+def build(path, size):
+    written, n = 0, 0
+    with open(path, 'w') as f:
+        while written < size:
+            data = message(n)
+            f.write(data)
+            written += len(data)
+            n += 1
+    return n
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=2048,
+                        help='Size of the generated fixture mailbox.')
+    parser.add_argument('--path', help='Existing mbox to read instead.')
+    args = parser.parse_args()
+
+    path = args.path
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(), 'alerts.mbox')
+        began = time.time()
+        count = build(path, args.size_mb * 1024 * 1024)
+        print("Generated %d messages in %.1fs" % (count, time.time() - began))
+    monitors = [{'monitor_id': 'monitor-%d' % i, 'term': x,
+                 'delivery': 'MAIL', 'email_address': ADDRESS}
+                for i, x in enumerate(TERMS)]
+    reader = MailReader(monitors)
+    size = os.path.getsize(path)
+    began = time.time()
+    entries = mapped = 0
+    for entry in reader.read(path):
+        entries += 1
+        mapped += entry['monitor_id'] is not None
+    elapsed = time.time() - began
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print("Read %.0f MB in %.1fs (%.1f MB/s), %d entries (%.0f/s), %d mapped,"
+          " peak RSS %.0f MB" % (size / 1048576.0, elapsed,
+                                 size / 1048576.0 / elapsed, entries,
+                                 entries / elapsed, mapped, peak))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Benchmark ingestion and query latency of the search index."""
+import os
+import random
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from google_alerts.search import SearchIndex
+
+WORDS = ("breach ransomware acme cloud outage patch vulnerability exploit "
+         "merger earnings lawsuit launch recall hiring layoffs startup "
+         "funding satellite election climate energy battery chip "
+         "privacy regulation antitrust quantum robot vaccine").split()
+
+
+def generate(count, monitors, start):
+    """Yield synthetic entries spread over a year."""
+    rand = random.Random(1)
+    for i in range(count):
+        monitor = rand.randrange(monitors)
+        yield {
+            'id': 'bench-%d' % i,
+            'monitor_id': 'monitor-%d' % monitor,
+            'term': WORDS[monitor % len(WORDS)],
+            'title': ' '.join(rand.choice(WORDS) for _ in range(8)),
+            'snippet': ' '.join(rand.choice(WORDS) for _ in range(30)),
+            'url': 'https://example.com/%d' % i,
+            'published': start + rand.randrange(365 * 86400)
+        }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--entries', type=int, default=1000000)
+    parser.add_argument('-b', '--batch', type=int, default=5000)
+    parser.add_argument('-m', '--monitors', type=int, default=200)
+    parser.add_argument('--path', default=None,
+                        help='Index file, a temporary file by default.')
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    index = SearchIndex(path)
+    start = int(time.time()) - 365 * 86400
+    began = time.time()
+    batch = list()
+    for entry in generate(args.entries, args.monitors, start):
+        batch.append(entry)
+        if len(batch) == args.batch:
+            index.add(batch)
+            batch = list()
+    if batch:
+        index.add(batch)
+    elapsed = time.time() - began
+    print("Ingested %d entries in %.1fs (%.0f entries/s)"
+          % (args.entries, elapsed, args.entries / elapsed))
+    index.optimize()
+
+    week = start + 300 * 86400
+    queries = [
+        ('"acme breach"', {}),
+        ('breach', {}),
+        ('ransomware NOT hiring', {}),
+        ('acme OR antitrust', {'since': week, 'until': week + 7 * 86400}),
+        ('quantum', {'monitor_id': 'monitor-7'}),
+        ('chip*', {'order': 'recent'}),
+        ('breach', {'offset': 1000}),
+    ]
+    for query, filters in queries:
+        timings = list()
+        for _ in range(20):
+            began = time.time()
+            index.search(query, **filters)
+            timings.append(time.time() - began)
+        timings.sort()
+        print("%-28s %-40s p50 %.2fms p95 %.2fms"
+              % (query, filters, timings[10] * 1000, timings[18] * 1000))
+    index.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
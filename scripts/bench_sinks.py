@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Benchmark the throughput of the result sinks against local receivers."""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from google_alerts.sinks import (HttpSink, JsonlSink, StdoutSink,
+                                 UnixSocketSink)
+
+
+class Collector(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def http_receiver():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Collector)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+def unix_receiver(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def drain():
+        while True:
+            conn, _ = server.accept()
+            while conn.recv(1 << 16):
+                pass
+            conn.close()
+
+    thread = threading.Thread(target=drain)
+    thread.daemon = True
+    thread.start()
+    return path
+
+
+def entries(count):
+    for i in range(count):
+        yield {'id': 'bench-%d' % i, 'monitor_id': 'monitor-%d' % (i % 50),
+               'term': 'acme', 'title': 'Acme Corp reports quarterly earnings',
+               'snippet': 'Acme Corp said on Tuesday that revenue rose ' * 3,
+               'url': 'https://example.com/%d' % i,
+               'published': 1589000000 + i}
+
+
+def run(name, sink, count, chunk):
+    began = time.time()
+    batch = list()
+    for entry in entries(count):
+        batch.append(entry)
+        if len(batch) == chunk:
+            sink.submit(batch)
+            batch = list()
+    sink.submit(batch)
+    sink.close()
+    elapsed = time.time() - began
+    print("%-16s %8d entries %6.2fs %10.0f entries/s %6d batches %d failed"
+          % (name, sink.delivered, elapsed, sink.delivered / elapsed,
+             sink.batches, sink.failed))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--entries', type=int, default=200000)
+    parser.add_argument('-b', '--batch', type=int, default=500)
+    parser.add_argument('-q', '--queue', type=int, default=10000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    options = {'batch_size': args.batch, 'queue_size': args.queue}
+    devnull = open(os.devnull, 'w')
+    sinks = [
+        ('stdout', lambda: StdoutSink(devnull, **options)),
+        ('jsonl', lambda: JsonlSink(os.path.join(workdir, 'out.jsonl'),
+                                    max_bytes=64 * 1024 * 1024, **options)),
+        ('unix', lambda: UnixSocketSink(
+            unix_receiver(os.path.join(workdir, 'sock')), **options)),
+        ('http', lambda: HttpSink(http_receiver(), **options)),
+    ]
+    for name, build in sinks:
+        run(name, build(), args.entries, 100)
+    devnull.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""Decoding of create and modify responses.
+
+The create response fixture is built by hand from the monitor rows found in
+the state, it is not a capture of a live response.
+"""
+import json
+import os
+import unittest
+
+from google_alerts import GoogleAlerts, MemorySessionStore
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+EXISTING = '062bc676ab9e9d9b:ac4752c338e8c363:com:en:US'
+CREATED = '062bc676ab9e9d9b:5d1e0c4f2a7b9e31:com:en:US'
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+class Response(object):
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+class Session(object):
+
+    def __init__(self, content):
+        self.content = content
+        self.posted = list()
+
+    def post(self, url, data=None, headers=None):
+        self.posted.append(json.loads(data['params']))
+        return Response(self.content)
+
+
+def client(rows):
+    ga = GoogleAlerts('user@example.com', 'password',
+                      session_store=MemorySessionStore())
+    ga.set_log_level('error')
+    ga._state = [[rows], None, 'request-x']
+    ga._state_fetched_at = 0
+    return ga
+
+
+class DecodeMonitorTest(unittest.TestCase):
+
+    def test_decodes_guarded_response(self):
+        ga = client([])
+        row = ga._decode_monitor(fixture('create_response.txt'),
+                                 lambda x: x['monitor_id'] == CREATED)
+        self.assertEqual(row[0], CREATED)
+        monitor = ga._parse_monitors([[[row]]])[0]
+        self.assertEqual(monitor['term'], 'acme')
+        self.assertEqual(monitor['delivery'], 'RSS')
+        self.assertEqual(monitor['match_type'], 'ALL')
+
+    def test_undecodable_response(self):
+        ga = client([])
+        self.assertIsNone(ga._decode_monitor(b'<html></html>',
+                                             lambda x: True))
+
+    def test_create_skips_echoed_monitors(self):
+        existing = json.loads(fixture('create_response.txt')[4:])[1][1]
+        ga = client([existing])
+        ga._session = Session(fixture('create_response.txt'))
+        monitors = ga.create('acme', {'delivery': 'RSS'})
+        ids = sorted(x['monitor_id'] for x in monitors)
+        self.assertEqual(ids, sorted([EXISTING, CREATED]))
+        self.assertEqual(len(ga.snapshot()[0][0]), 2)
+
+    def test_create_logs_undecodable_response(self):
+        ga = client([])
+        ga._session = Session(b'<html></html>')
+        ga._process_state = lambda: ga._state
+        with self.assertLogs(GoogleAlerts.NAME, 'INFO') as logs:
+            self.assertEqual(ga.create('acme', {'delivery': 'RSS'}), [])
+        self.assertIn('could not be decoded', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
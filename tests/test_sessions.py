@@ -0,0 +1,87 @@
+"""Session files shared between processes."""
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+
+from google_alerts import FileSessionStore, GoogleAlerts
+
+EMAIL = 'user@example.com'
+PROCESSES = 6
+
+
+class StubClient(GoogleAlerts):
+    """Client whose network calls are replaced by local bookkeeping."""
+
+    def _load_cookies(self, cookies):
+        self._cookies = cookies
+
+    def _session_valid(self):
+        return bool(getattr(self, '_cookies', None))
+
+    def _login(self):
+        with open(os.path.join(self._sessions.path, 'logins'), 'a') as f:
+            f.write('%d\n' % os.getpid())
+        time.sleep(0.2)
+        self._cookies = {'SID': str(os.getpid())}
+        self._sessions.save(self._email, self._cookies)
+
+    def _process_state(self):
+        self._state = [[[]], None, 'request-x']
+        return self._state
+
+
+def authenticate(path, start):
+    start.wait()
+    ga = StubClient(EMAIL, 'password',
+                    session_store=FileSessionStore(path, fallback=None))
+    ga.set_log_level('error')
+    ga.authenticate()
+
+
+class FileSessionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.legacy = os.path.join(self.path, 'session')
+        with open(self.legacy, 'wb') as f:
+            pickle.dump({'SID': 'legacy'}, f, protocol=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_legacy_session_only_for_its_owner(self):
+        store = FileSessionStore(self.path, self.legacy, owner=EMAIL)
+        self.assertIsNone(store.load('other@example.com'))
+        self.assertTrue(os.path.exists(self.legacy))
+        self.assertEqual(store.load(EMAIL.upper()), {'SID': 'legacy'})
+        self.assertFalse(os.path.exists(self.legacy))
+        self.assertEqual(store.load(EMAIL), {'SID': 'legacy'})
+
+    def test_legacy_owner_from_config(self):
+        with open(os.path.join(self.path, 'config.json'), 'w') as f:
+            f.write('{"email": "%s"}' % EMAIL)
+        store = FileSessionStore(self.path, self.legacy)
+        self.assertIsNone(store.load('other@example.com'))
+        self.assertEqual(store.load(EMAIL), {'SID': 'legacy'})
+
+    def test_single_login_across_processes(self):
+        start = multiprocessing.Event()
+        workers = [multiprocessing.Process(target=authenticate,
+                                           args=(self.path, start))
+                   for _ in range(PROCESSES)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join(30)
+            self.assertEqual(worker.exitcode, 0)
+        with open(os.path.join(self.path, 'logins')) as f:
+            self.assertEqual(len(f.read().split()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()